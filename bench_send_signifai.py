@@ -0,0 +1,156 @@
+#!/usr/bin/python
+
+#
+# Copyright 2018 SignifAI, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+
+"""
+Benchmarks for send_signifai.py. Run with the name of a benchmark:
+
+    python ./bench_send_signifai.py memory --events 1000000
+    python ./bench_send_signifai.py serialize
+"""
+
+from __future__ import absolute_import, print_function
+
+import argparse
+import gc
+import sys
+import time
+
+import send_signifai
+
+try:
+    # python3
+    import tracemalloc
+except ImportError:
+    # python2
+    tracemalloc = None
+
+
+__author__ = "SignifAI, Inc."
+__copyright__ = "Copyright (C) 2018, SignifAI, Inc."
+__version__ = "1.0"
+__license__ = "ASLv2"
+
+
+def make_event(i):
+    return send_signifai.prepare_REST_event({
+        "EVENT.DATE": "2018.01.14",
+        "EVENT.TIME": "02:31:00",
+        "EVENT.ID": str(1000000 + i),
+        "TRIGGER.DESCRIPTION": "Disk usage above 90% on /var",
+        "TRIGGER.ID": str(13000 + i % 5000),
+        "TRIGGER.NSEVERITY": str(i % 6),
+        "TRIGGER.NAME": "Free disk space is less than 10% on volume /var",
+        "TRIGGER.EXPRESSION": "{13297}<10",
+        "HOST.NAME": "host{num:05d}.example.net".format(num=i % 20000),
+        "TRIGGER.STATUS": "PROBLEM" if i % 2 else "OK"
+    })
+
+
+def bench_memory(args):
+    if tracemalloc is None:
+        print("The memory benchmark needs tracemalloc (python 3.4+)")
+        return 1
+
+    gc.collect()
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+
+    events = [make_event(i) for i in range(args.events)]
+    dict_bytes = tracemalloc.get_traced_memory()[0] - base
+
+    # The values are shared with the dicts, so once those are gone
+    # what's left is what the compact form costs on its own
+    compact = [send_signifai.CompactEvent.from_dict(e) for e in events]
+    del events
+    gc.collect()
+    compact_bytes = tracemalloc.get_traced_memory()[0] - base
+
+    encoded = [e.encode() for e in compact]
+    del compact
+    gc.collect()
+    encoded_bytes = tracemalloc.get_traced_memory()[0] - base
+    tracemalloc.stop()
+
+    print("{n} queued events".format(n=args.events))
+    for name, total in (("dict", dict_bytes),
+                        ("CompactEvent", compact_bytes),
+                        ("spool record", encoded_bytes)):
+        print("  {name:<14} {total:>14,d} bytes  {per:>8.1f} bytes/event"
+              .format(name=name, total=total,
+                      per=float(total) / args.events))
+    return 0
+
+
+def time_per_event(func, events, min_time=0.2):
+    rounds = 0
+    start = time.time()
+    while True:
+        func()
+        rounds += 1
+        elapsed = time.time() - start
+        if elapsed >= min_time:
+            return elapsed / rounds / len(events) * 1000000
+
+
+def bench_serialize(args):
+    batch_sizes = [int(n) for n in args.batch_sizes.split(",")]
+    events = [make_event(i) for i in range(max(batch_sizes))]
+    names = list(send_signifai.SERIALIZERS)
+    if names == ["stdlib"]:
+        print("No faster JSON library installed (orjson, ujson); "
+              "only the stdlib is measured")
+
+    print("{0:>10} {1:>10} {2:>14} {3:>14} {4:>9}".format(
+        "batch", "json", "encode us/ev", "decode us/ev", "speedup"))
+    for size in batch_sizes:
+        batch = events[:size]
+        baseline = None
+        for name in reversed(names):
+            send_signifai.use_serializer(name)
+            body = next(send_signifai.split_batches(batch, sys.maxsize))[1]
+            encode = time_per_event(
+                lambda: list(send_signifai.split_batches(batch, sys.maxsize)),
+                batch)
+            decode = time_per_event(lambda: send_signifai.loads_json(body),
+                                    batch)
+            if baseline is None:
+                baseline = encode + decode
+            print("{0:>10} {1:>10} {2:>14.2f} {3:>14.2f} {4:>8.2f}x".format(
+                size, name, encode, decode, baseline / (encode + decode)))
+    send_signifai.use_serializer()
+    return 0
+
+
+BENCHMARKS = {
+    "memory": bench_memory,
+    "serialize": bench_serialize,
+}
+
+
+def main(argv=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description="send_signifai benchmarks")
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS))
+    parser.add_argument("--events", type=int, default=1000000)
+    parser.add_argument("--batch-sizes", default="1,10,100,1000,10000",
+                        help="comma separated, for the serialize benchmark")
+    args = parser.parse_args(argv)
+    return BENCHMARKS[args.benchmark](args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -18,12 +18,18 @@
 
 from __future__ import absolute_import
 
+import argparse
+import hashlib
 import json
 import logging
 import os
 import socket
+import struct
 import sys
+import tempfile
+import threading
 import time
+from collections import OrderedDict
 from copy import deepcopy
 from datetime import datetime, time as datetime_time
 
@@ -34,6 +40,18 @@ try:
 except ImportError:
     bugsnag = None
 
+try:
+    # Several times faster than the json module for our payloads;
+    # we fall back to ujson and then the stdlib when it's missing
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
 try:
     # python3
     import http.client as http_client
@@ -41,6 +59,29 @@ except ImportError:
     # python2
     import httplib as http_client
 
+try:
+    # python3
+    import http.server as http_server
+    import queue
+except ImportError:
+    # python2
+    import BaseHTTPServer as http_server
+    import Queue as queue
+
+try:
+    # python3
+    from urllib.parse import urlsplit
+except ImportError:
+    # python2
+    from urlparse import urlsplit
+
+try:
+    # python2
+    string_types = basestring
+except NameError:
+    # python3
+    string_types = str
+
 __author__ = "SignifAI, Inc."
 __copyright__ = "Copyright (C) 2018, SignifAI, Inc."
 __version__ = "1.0"
@@ -74,6 +115,61 @@ MORE_MAPS = {
 
 DEFAULT_POST_URI = "/v1/incidents"
 
+DEFAULT_MAX_ATTR_BYTES = 16 * 1024
+DEFAULT_MAX_EVENT_BYTES = 64 * 1024
+DEFAULT_MAX_BODY_BYTES = 1024 * 1024
+TRUNCATION_MARKER = "...[truncated]"
+# Values that identify an event or come from a fixed set; a shortened
+# one would be a different host, trigger or severity, so they're never
+# truncated
+UNTRUNCATED_KEYS = frozenset([
+    "host", "application", "service", "value", "state", "event_source",
+    "timestamp", "zabbix/event/id"
+])
+
+
+def _stdlib_dumps(obj):
+    return json.dumps(obj).encode("utf-8")
+
+
+def _ujson_dumps(obj):
+    # ujson escapes "/" as "\/" unless told not to; the stdlib doesn't
+    return ujson.dumps(obj, escape_forward_slashes=False).encode("utf-8")
+
+
+# name -> (dumps, loads); dumps always returns UTF-8 encoded bytes
+SERIALIZERS = OrderedDict()
+if orjson:
+    SERIALIZERS["orjson"] = (orjson.dumps, orjson.loads)
+if ujson:
+    SERIALIZERS["ujson"] = (_ujson_dumps, ujson.loads)
+SERIALIZERS["stdlib"] = (_stdlib_dumps, json.loads)
+
+
+def use_serializer(name=None):
+    """
+    Switch the JSON implementation used for collector requests and
+    responses and the Zabbix API. Without a name, $SIGNIFAI_JSON or the
+    fastest one installed is used; a $SIGNIFAI_JSON naming one that
+    isn't installed only gets a warning and the stdlib.
+    """
+    global JSON_SERIALIZER, dumps_json, loads_json
+    if name is None:
+        name = os.environ.get("SIGNIFAI_JSON") or next(iter(SERIALIZERS))
+        if name not in SERIALIZERS:
+            logging.getLogger("http_post").warning(
+                "SIGNIFAI_JSON={name} isn't available; using stdlib"
+                .format(name=name))
+            name = "stdlib"
+    if name not in SERIALIZERS:
+        raise ValueError("JSON serializer {name} isn't available".format(
+            name=name))
+    JSON_SERIALIZER = name
+    dumps_json, loads_json = SERIALIZERS[name]
+
+
+use_serializer()
+
 
 def bugsnag_notify(exception, metadata, log=None):
     if not log:
@@ -130,7 +226,8 @@ def POST_data(auth_key, data,
               signifai_uri=DEFAULT_POST_URI,
               timeout=5,
               attempts=5,
-              httpsconn=http_client.HTTPSConnection):
+              httpsconn=http_client.HTTPSConnection,
+              body=None):
     log = logging.getLogger("http_post")
     client = None
     retries = 0
@@ -154,65 +251,101 @@ def POST_data(auth_key, data,
         bugsnag_notify(socket.timeout, bugsnag_metadata)
         return False
     else:
-        headers = {
-            "Authorization": "Bearer {auth_key}".format(auth_key=auth_key),
-            "Content-Type": "application/json",
-            "Accept": "application/json"
-        }
-        bugsnag_metadata['headers'] = headers
         try:
-            client.request("POST", signifai_uri, body=json.dumps(data),
-                           headers=headers)
-            res = client.getresponse()
-        except socket.timeout as exc:
-            # ... don't think we should retry the POST
+            result, status = POST_to_client(client, auth_key, data,
+                                            signifai_uri, bugsnag_metadata,
+                                            body)
+        finally:
+            client.close()
+        return result
+
+
+def POST_to_client(client, auth_key, data, signifai_uri, bugsnag_metadata,
+                   body=None, report_errors=True):
+    """
+    POST `data` over an already connected `client`. Returns the same
+    True/None/False result as POST_data, along with the HTTP status of
+    the response (None when the request never got one, which is only
+    reported when `report_errors` is set).
+    """
+    log = logging.getLogger("http_post")
+    headers = {
+        "Authorization": "Bearer {auth_key}".format(auth_key=auth_key),
+        "Content-Type": "application/json",
+        "Accept": "application/json"
+    }
+    bugsnag_metadata['headers'] = headers
+    try:
+        if body is None:
+            body = dumps_json(data)
+        client.request("POST", signifai_uri, body=body, headers=headers)
+        res = client.getresponse()
+    except socket.timeout as exc:
+        # ... don't think we should retry the POST
+        if report_errors:
             log.fatal("POST timed out...?")
             bugsnag_notify(exc, bugsnag_metadata)
-            return False
-        except (http_client.HTTPException, socket.error) as http_exc:
-            # nope
+        return False, None
+    except (http_client.HTTPException, socket.error) as http_exc:
+        # nope
+        if report_errors:
             log.fatal("Couldn't POST to SignifAi Collector", exc_info=True)
             bugsnag_notify(http_exc, bugsnag_metadata)
-            return False
+        return False, None
 
-        if 200 <= res.status < 300:
-            response_text = None
-            try:
-                response_text = res.read()
-                bugsnag_metadata['collector_response'] = response_text
-                collector_response = json.loads(response_text)
-            except ValueError as exc:
-                log.fatal("Didn't receive valid JSON response from collector")
-                bugsnag_notify(exc, bugsnag_metadata)
-                return False
-            except IOError as exc:
-                log.fatal("Couldn't read response from collector",
-                          exc_info=True)
-                bugsnag_notify(exc, bugsnag_metadata)
-            else:
-                if (not collector_response['success'] or
-                        collector_response['failed_events']):
-                    errs = collector_response['failed_events']
-                    log.fatal("Errors submitting events: {errs}"
-                              .format(errs=errs))
-                    # Treat it like a ValueError for bugsnag
-                    failed_events = collector_response['failed_events']
-                    bugsnag_metadata['failed_events'] = failed_events
-                    bugsnag_notify(ValueError("errors submitting events"),
-                                   bugsnag_metadata)
-                    # not really False but not really True
-                    return None
-                else:
-                    return True
-        else:
-            log.fatal("Received error from SignifAi Collector, body follows: ")
+    if 200 <= res.status < 300:
+        response_text = None
+        try:
             response_text = res.read()
             bugsnag_metadata['collector_response'] = response_text
-            log.fatal(response_text)
-
-            bugsnag_notify(ValueError("Error from SignifAi collector"),
+            collector_response = loads_json(response_text)
+        except ValueError as exc:
+            log.fatal("Didn't receive valid JSON response from collector")
+            bugsnag_notify(exc, bugsnag_metadata)
+            return False, res.status
+        except IOError as exc:
+            log.fatal("Couldn't read response from collector",
+                      exc_info=True)
+            bugsnag_notify(exc, bugsnag_metadata)
+            return None, res.status
+        if (not isinstance(collector_response, dict) or
+                'success' not in collector_response):
+            log.fatal("Didn't receive a valid response from collector")
+            bugsnag_notify(ValueError("malformed collector response"),
                            bugsnag_metadata)
-            return False
+            return False, res.status
+        elif (not collector_response['success'] or
+                collector_response.get('failed_events')):
+            errs = collector_response.get('failed_events')
+            log.fatal("Errors submitting events: {errs}"
+                      .format(errs=errs))
+            # Treat it like a ValueError for bugsnag
+            bugsnag_metadata['failed_events'] = errs
+            bugsnag_notify(ValueError("errors submitting events"),
+                           bugsnag_metadata)
+            # not really False but not really True
+            return None, res.status
+        else:
+            return True, res.status
+    else:
+        log.fatal("Received error from SignifAi Collector, body follows: ")
+        response_text = res.read()
+        bugsnag_metadata['collector_response'] = response_text
+        log.fatal(response_text)
+
+        bugsnag_notify(ValueError("Error from SignifAi collector"),
+                       bugsnag_metadata)
+        return False, res.status
+
+
+def should_retry(result, status):
+    """
+    Whether a failed POST is worth sending again: only when it never
+    got an answer, or the collector is overloaded or broken
+    """
+    if result is not False:
+        return False
+    return status is None or status == 429 or status >= 500
 
 
 def parse_zabbix_msg(data):
@@ -249,21 +382,195 @@ def zabbix_key_to_signifai_key(k):
     return i
 
 
-def prepare_REST_event(parsed_data):
+DEFAULT_MAPPING_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                    "signifai_mapping.json")
+MAPPING_OPTIONS = set(["dest", "placement", "map", "default", "required"])
+# Bump whenever MappingPlan.to_json output changes shape
+MAPPING_PLAN_FORMAT = 1
+
+
+class MappingPlan(object):
+    """
+    Compiled form of a mapping config: for every Zabbix macro, where
+    its value goes in the event and through which value map.
+    `entries` maps macro -> (dst_key, in_attributes, value_map).
+    """
+
+    __slots__ = ("entries", "required", "defaults")
+
+    def __init__(self, entries, required, defaults):
+        self.entries = entries
+        self.required = frozenset(required)
+        self.defaults = tuple(defaults)
+
+    def to_json(self):
+        return {
+            "entries": self.entries,
+            "required": sorted(self.required),
+            "defaults": self.defaults
+        }
+
+    @classmethod
+    def from_json(cls, data):
+        entries = {}
+        for k, (dst_key, in_attributes, value_map) in data["entries"].items():
+            entries[k] = (dst_key, in_attributes, value_map)
+        return cls(entries, data["required"],
+                   [tuple(d) for d in data["defaults"]])
+
+
+def mapping_config_from_constants(attr_map=ATTR_MAP, bare_attrs=BARE_ATTRS,
+                                  more_maps=MORE_MAPS):
+    config = {"attributes": {}}
+    for k, dst_key in attr_map.items():
+        options = {"dest": dst_key}
+        if dst_key in bare_attrs:
+            options["placement"] = "attributes"
+        if k in more_maps:
+            options["map"] = more_maps[k]
+        config["attributes"][k] = options
+    return config
+
+
+def compile_mapping(config):
+    if not isinstance(config, dict) or \
+            not isinstance(config.get("attributes"), dict):
+        raise ValueError("Mapping config needs an 'attributes' object")
+
+    entries = {}
+    required = []
+    defaults = []
+    for k, options in config["attributes"].items():
+        if not isinstance(options, dict):
+            raise ValueError("Mapping for {key} must be an object"
+                             .format(key=k))
+        unknown = set(options) - MAPPING_OPTIONS
+        if unknown:
+            raise ValueError("Unknown options for {key}: {opts}".format(
+                key=k, opts=str.join(", ", sorted(unknown))))
+
+        dst_key = options.get("dest")
+        if not dst_key or not isinstance(dst_key, string_types):
+            raise ValueError("Mapping for {key} needs a 'dest'".format(key=k))
+
+        placement = options.get("placement")
+        if placement is None:
+            in_attributes = "/" in dst_key
+        elif placement in ("root", "attributes"):
+            in_attributes = placement == "attributes"
+        else:
+            raise ValueError("Placement for {key} must be 'root' or "
+                             "'attributes'".format(key=k))
+
+        value_map = options.get("map")
+        if value_map is not None:
+            if not isinstance(value_map, dict):
+                raise ValueError("Value map for {key} must be an object"
+                                 .format(key=k))
+            value_map = dict((src.upper(), dst)
+                             for src, dst in value_map.items())
+
+        if "default" in options:
+            if not isinstance(options["default"], string_types):
+                raise ValueError("Default for {key} must be a string"
+                                 .format(key=k))
+            defaults.append((k, options["default"]))
+        if options.get("required", "default" not in options):
+            required.append(k)
+        entries[k] = (dst_key, in_attributes, value_map)
+
+    return MappingPlan(entries, required, defaults)
+
+
+def load_mapping(path, cache_path=None):
+    """
+    Load the mapping config at `path`, reusing the plan compiled on a
+    previous run when the config hasn't changed. The cache is only used
+    if it was written by this version of the script, and then trusted
+    outright if the config's mtime and size match, and otherwise only
+    if its SHA-1 still matches. Anything wrong with it just means
+    compiling the config again.
+    """
+    if cache_path is None:
+        cache_path = path + ".cache"
+    stat = os.stat(path)
+
+    cached = None
+    try:
+        with open(cache_path, "r") as cache_file:
+            cached = json.load(cache_file)
+        if cached["version"] != __version__ or \
+                cached["format"] != MAPPING_PLAN_FORMAT:
+            cached = None
+        elif cached["mtime"] == stat.st_mtime and \
+                cached["size"] == stat.st_size:
+            return MappingPlan.from_json(cached["plan"])
+    except (IOError, OSError, ValueError, KeyError, TypeError,
+            AttributeError):
+        cached = None
+
+    with open(path, "rb") as config_file:
+        raw_config = config_file.read()
+    digest = hashlib.sha1(raw_config).hexdigest()
+    plan = None
+    if cached and cached.get("sha1") == digest:
+        try:
+            plan = MappingPlan.from_json(cached["plan"])
+        except (ValueError, KeyError, TypeError, AttributeError):
+            plan = None
+    if plan is None:
+        try:
+            config = json.loads(raw_config.decode("utf-8"))
+        except ValueError as exc:
+            raise ValueError("Couldn't parse mapping config {path}: {msg}"
+                             .format(path=path, msg=exc))
+        plan = compile_mapping(config)
+
+    try:
+        write_file_atomic(cache_path, json.dumps({
+            "version": __version__,
+            "format": MAPPING_PLAN_FORMAT,
+            "mtime": stat.st_mtime,
+            "size": stat.st_size,
+            "sha1": digest,
+            "plan": plan.to_json()
+        }))
+    except (IOError, OSError):
+        # A read-only install just means compiling every time
+        logging.getLogger("mapping").info("Couldn't write mapping cache",
+                                          exc_info=True)
+    return plan
+
+
+def default_mapping():
+    if os.path.exists(DEFAULT_MAPPING_PATH):
+        return load_mapping(DEFAULT_MAPPING_PATH)
+    return None
+
+
+BUILTIN_MAPPING = compile_mapping(mapping_config_from_constants())
+
+
+def prepare_REST_event(parsed_data, mapping=None):
+    if mapping is None:
+        mapping = BUILTIN_MAPPING
     event = {"attributes": {}}
-    missing = set(ATTR_MAP.keys())
+    missing = set(mapping.required)
     event_date = None
     event_time = None
-    for k, v in parsed_data.items():
-        if k in ATTR_MAP:
-            missing.remove(k)
-            dst_key = ATTR_MAP[k]
-            if k in MORE_MAPS:
-                v = MORE_MAPS[k][v.upper()]
+    items = list(parsed_data.items())
+    items.extend((k, v) for k, v in mapping.defaults if k not in parsed_data)
+    for k, v in items:
+        entry = mapping.entries.get(k)
+        if entry is not None:
+            missing.discard(k)
+            dst_key, in_attributes, value_map = entry
+            if value_map is not None:
+                v = value_map[v.upper()]
 
             # Check if we want to put this mapped attr
             # into 'attributes' or the root of the event
-            if "/" in dst_key or dst_key in BARE_ATTRS:
+            if in_attributes:
                 event["attributes"][dst_key] = v
             else:
                 event[dst_key] = v
@@ -309,7 +616,1839 @@ def prepare_REST_event(parsed_data):
     return event
 
 
+def truncate_value(value, max_bytes, marker=TRUNCATION_MARKER):
+    if isinstance(value, bytes):
+        encoded = value
+    else:
+        encoded = value.encode("utf-8")
+    if len(encoded) <= max_bytes:
+        return value
+    encoded_marker = marker.encode("utf-8")
+    if max_bytes <= len(encoded_marker):
+        # No room for any of the value; as much marker as fits
+        return encoded_marker[:max_bytes].decode("utf-8", "ignore")
+    # 'ignore' drops a multi-byte character cut in half
+    return encoded[:max_bytes - len(encoded_marker)].decode(
+        "utf-8", "ignore") + marker
+
+
+def untruncated_keys(mapping=None):
+    """
+    The keys truncate_event has to leave alone for events prepared with
+    `mapping`: UNTRUNCATED_KEYS and whatever its value maps produce
+    """
+    if mapping is None:
+        mapping = BUILTIN_MAPPING
+    return UNTRUNCATED_KEYS.union(
+        dst_key for dst_key, _, value_map in mapping.entries.values()
+        if value_map is not None)
+
+
+DEFAULT_UNTRUNCATED_KEYS = untruncated_keys(BUILTIN_MAPPING)
+
+
+def json_size_bound(event):
+    """
+    An upper bound on the size of `event` encoded as JSON, found without
+    encoding it: escaped, no character takes more than 12 bytes (a
+    \\uXXXX surrogate pair) and no member more than 8 bytes of quotes
+    and separators
+    """
+    size = 0
+    for container in (event, event["attributes"]):
+        size += 2
+        for k, v in container.items():
+            size += 12 * len(k) + 8
+            if isinstance(v, string_types):
+                size += 12 * len(v)
+            elif v is not event["attributes"]:
+                size += len(str(v)) + 24
+    return size
+
+
+def truncate_event(event, max_attr_bytes=DEFAULT_MAX_ATTR_BYTES,
+                   max_event_bytes=DEFAULT_MAX_EVENT_BYTES,
+                   marker=TRUNCATION_MARKER, keep=None):
+    """
+    Cap every string value of `event` at `max_attr_bytes` and then,
+    while the encoded event is still larger than `max_event_bytes`,
+    keep shortening its largest value. Values under the keys in `keep`
+    (`untruncated_keys()` by default) are never touched. The event is
+    modified in place. Events that can't be that large aren't encoded
+    at all.
+    """
+    _truncate_event(event, max_attr_bytes, max_event_bytes, marker, keep)
+    return event
+
+
+def truncate_and_encode(event, max_attr_bytes=DEFAULT_MAX_ATTR_BYTES,
+                        max_event_bytes=DEFAULT_MAX_EVENT_BYTES,
+                        marker=TRUNCATION_MARKER, keep=None):
+    """
+    truncate_event, returning the JSON encoding of the truncated event
+    so `split_batches` needn't encode it again
+    """
+    body = _truncate_event(event, max_attr_bytes, max_event_bytes, marker,
+                           keep)
+    if body is None:
+        body = dumps_json(event)
+    return body
+
+
+def _truncate_event(event, max_attr_bytes, max_event_bytes, marker, keep):
+    if keep is None:
+        keep = DEFAULT_UNTRUNCATED_KEYS
+    containers = (event, event["attributes"])
+    if max_attr_bytes:
+        for container in containers:
+            for k, v in container.items():
+                if isinstance(v, string_types) and k not in keep:
+                    container[k] = truncate_value(v, max_attr_bytes, marker)
+
+    if not max_event_bytes or json_size_bound(event) <= max_event_bytes:
+        return None
+    body = dumps_json(event)
+    while len(body) > max_event_bytes:
+        candidates = [(len(v), k, container) for container in containers
+                      for k, v in container.items()
+                      if isinstance(v, string_types) and k not in keep]
+        if not candidates:
+            break
+        value_len, k, container = max(candidates)
+        if value_len <= len(marker):
+            break
+        container[k] = truncate_value(
+            container[k],
+            max(len(marker), value_len - (len(body) - max_event_bytes)),
+            marker)
+        body = dumps_json(event)
+    return body
+
+
+def split_batches(events, max_body_bytes=DEFAULT_MAX_BODY_BYTES,
+                  encoded=None):
+    """
+    Split `events` into batches whose request body stays under
+    `max_body_bytes`, yielding (events, body) pairs. Each event is
+    encoded exactly once and the body is built from those encodings;
+    `encoded` can hand in encodings made earlier, one per event.
+    """
+    prefix = b'{"events":['
+    separator = b','
+    suffix = b']}'
+    overhead = len(prefix) + len(suffix)
+
+    batch = []
+    parts = []
+    size = overhead
+    for i, event in enumerate(events):
+        if encoded is not None:
+            part = encoded[i]
+        elif isinstance(event, CompactEvent):
+            part = event.to_json()
+        else:
+            part = dumps_json(event)
+        added = len(part) + (len(separator) if parts else 0)
+        if parts and size + added > max_body_bytes:
+            yield batch, prefix + separator.join(parts) + suffix
+            batch = []
+            parts = []
+            size = overhead
+            added = len(part)
+        if size + added > max_body_bytes:
+            logging.getLogger("http_post").warning(
+                "Event alone is larger than {limit} bytes; sending anyway"
+                .format(limit=max_body_bytes))
+        batch.append(event)
+        parts.append(part)
+        size += added
+    if parts:
+        yield batch, prefix + separator.join(parts) + suffix
+
+
+def POST_events(auth_key, events, max_body_bytes=DEFAULT_MAX_BODY_BYTES,
+                encoded=None, **post_kwargs):
+    """
+    POST `events` in as many requests as `max_body_bytes` requires.
+    Returns False as soon as one request fails outright, None if the
+    collector refused any events and True otherwise.
+    """
+    result = True
+    for batch, body in split_batches(events, max_body_bytes, encoded):
+        batch_result = POST_data(auth_key, {"events": batch}, body=body,
+                                 **post_kwargs)
+        if batch_result is False:
+            return False
+        if batch_result is None:
+            result = None
+    return result
+
+
+try:
+    # python3
+    _intern = sys.intern
+except AttributeError:
+    # python2
+    _intern = intern
+
+
+def intern_key(key):
+    try:
+        return _intern(key)
+    except TypeError:
+        # python2 won't intern unicode, but ASCII keys can be str there
+        try:
+            return _intern(key.encode("ascii"))
+        except (AttributeError, TypeError, UnicodeError):
+            return key
+
+
+# Key ids of the fixed spool schema. New keys go at the end; existing
+# ids must never change or old spools decode wrongly.
+SCHEMA_KEYS = tuple(intern_key(k) for k in (
+    "host", "application", "value", "event_description", "timestamp",
+    "event_source", "service", "state", "annotations/description",
+    "alert/condition", "zabbix/event/id",
+))
+SCHEMA_KEY_IDS = dict((k, i) for i, k in enumerate(SCHEMA_KEYS))
+INLINE_KEY = 255
+VALUE_STR = 0
+VALUE_JSON = 1
+RECORD_HEADER = struct.Struct(">IQ")
+# Magic and generation at the start of every spool file; compaction
+# bumps the generation so a stale offset is never applied to a new file
+SPOOL_HEADER = struct.Struct(">4sQ")
+SPOOL_MAGIC = b"SGSP"
+SEQUENCE_ATTR = "zabbix/sequence"
+FIELD_HEADER = struct.Struct(">BBI")
+SHORT = struct.Struct(">H")
+
+
+class CompactEvent(object):
+    """
+    An event as prepare_REST_event builds it, held as two flat tuples
+    of alternating (interned) keys and values instead of nested dicts.
+    `to_dict`/`to_json` rebuild the original event when it's sent.
+    """
+
+    __slots__ = ("fields", "attributes")
+
+    def __init__(self, fields, attributes):
+        self.fields = fields
+        self.attributes = attributes
+
+    @staticmethod
+    def _flatten(items):
+        flat = []
+        for k, v in items:
+            flat.append(intern_key(k))
+            flat.append(v)
+        return tuple(flat)
+
+    @classmethod
+    def from_dict(cls, event):
+        return cls(
+            cls._flatten((k, v) for k, v in event.items()
+                         if k != "attributes"),
+            cls._flatten(event.get("attributes", {}).items()))
+
+    def get(self, key, default=None):
+        for i in range(0, len(self.fields), 2):
+            if self.fields[i] == key:
+                return self.fields[i + 1]
+        return default
+
+    def to_dict(self):
+        event = {"attributes": dict(zip(self.attributes[::2],
+                                        self.attributes[1::2]))}
+        event.update(zip(self.fields[::2], self.fields[1::2]))
+        return event
+
+    def to_json(self):
+        return dumps_json(self.to_dict())
+
+    def __eq__(self, other):
+        if isinstance(other, CompactEvent):
+            other = other.to_dict()
+        return self.to_dict() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "CompactEvent({event!r})".format(event=self.to_dict())
+
+    @staticmethod
+    def _encode_fields(flat, out):
+        out.append(SHORT.pack(len(flat) // 2))
+        for i in range(0, len(flat), 2):
+            k, v = flat[i], flat[i + 1]
+            key_id = SCHEMA_KEY_IDS.get(k, INLINE_KEY)
+            if isinstance(v, string_types):
+                value_type = VALUE_STR
+            else:
+                value_type = VALUE_JSON
+                v = json.dumps(v)
+            if not isinstance(v, bytes):
+                v = v.encode("utf-8")
+            out.append(FIELD_HEADER.pack(key_id, value_type, len(v)))
+            if key_id == INLINE_KEY:
+                raw_key = k if isinstance(k, bytes) else k.encode("utf-8")
+                out.append(SHORT.pack(len(raw_key)))
+                out.append(raw_key)
+            out.append(v)
+
+    @staticmethod
+    def _decode_fields(data, pos):
+        count, = SHORT.unpack_from(data, pos)
+        pos += SHORT.size
+        flat = []
+        for _ in range(count):
+            key_id, value_type, value_len = FIELD_HEADER.unpack_from(data, pos)
+            pos += FIELD_HEADER.size
+            if key_id == INLINE_KEY:
+                key_len, = SHORT.unpack_from(data, pos)
+                pos += SHORT.size
+                k = intern_key(data[pos:pos + key_len].decode("utf-8"))
+                pos += key_len
+            else:
+                k = SCHEMA_KEYS[key_id]
+            v = data[pos:pos + value_len].decode("utf-8")
+            pos += value_len
+            if value_type == VALUE_JSON:
+                v = json.loads(v)
+            flat.append(k)
+            flat.append(v)
+        return tuple(flat), pos
+
+    def encode(self):
+        out = []
+        self._encode_fields(self.fields, out)
+        self._encode_fields(self.attributes, out)
+        return b"".join(out)
+
+    @classmethod
+    def decode(cls, data, pos=0):
+        fields, pos = cls._decode_fields(data, pos)
+        attributes, pos = cls._decode_fields(data, pos)
+        return cls(fields, attributes)
+
+
+def encode_spool_record(api_key, event):
+    if not isinstance(event, CompactEvent):
+        event = CompactEvent.from_dict(event)
+    raw_key = (api_key or "").encode("utf-8")
+    return SHORT.pack(len(raw_key)) + raw_key + event.encode()
+
+
+def decode_spool_record(payload, sequence=None):
+    key_len, = SHORT.unpack_from(payload, 0)
+    api_key = payload[SHORT.size:SHORT.size + key_len].decode("utf-8")
+    event = CompactEvent.decode(payload, SHORT.size + key_len)
+    if sequence is not None:
+        event.attributes += (SEQUENCE_ATTR, sequence)
+    return api_key, event
+
+
+def ordering_key(event):
+    """
+    Events with the same key have to reach the collector in the order
+    they happened, or a recovery could land before its problem
+    """
+    return event.get("application"), event.get("host")
+
+
+def spool_sequence(event):
+    """The sequence number `decode_spool_record` gave `event`"""
+    if event.attributes[-2:-1] == (SEQUENCE_ATTR,):
+        return event.attributes[-1]
+    return None
+
+
+def write_file_atomic(path, text):
+    # A temporary file of its own, so concurrent writers (separate
+    # script invocations sharing a cache, say) don't clobber each other
+    fd, tmp_path = tempfile.mkstemp(
+        prefix=os.path.basename(path) + ".", suffix=".tmp",
+        dir=os.path.dirname(path) or ".")
+    try:
+        with os.fdopen(fd, "w") as tmp:
+            tmp.write(text)
+            tmp.flush()
+            os.fsync(tmp.fileno())
+        os.rename(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+
+def copy_bytes(source, dest, count):
+    while count > 0:
+        data = source.read(min(65536, count))
+        if not data:
+            raise IOError("{name} ended early".format(name=source.name))
+        dest.write(data)
+        count -= len(data)
+
+
+class SpoolFull(Exception):
+    pass
+
+
+class SpoolBatch(object):
+    def __init__(self, start, end, records, sequence):
+        self.start = start
+        self.end = end
+        self.records = records
+        self.sequence = sequence
+
+
+class EventSpool(object):
+    """
+    Durable, append-only queue of prepared events.
+
+    Every record is a length-prefixed API key and CompactEvent in the
+    binary layout of `encode_spool_record`; records are read back as
+    (api_key, CompactEvent) pairs. Each record also gets a sequence
+    number, increasing across restarts, that is added to the event as
+    the SEQUENCE_ATTR attribute when it's read.
+    `append` only returns once the record has been fsync'd; writers
+    that arrive while an fsync is running are covered together by the
+    next one. The delivery cursor is persisted to `<path>.offset` as
+    batches are acknowledged, so anything not yet delivered is replayed
+    after a restart. The cursor names the file generation it belongs to;
+    compaction writes the new file and points the cursor at it before
+    renaming it into place, and `_open` finishes or discards a
+    compaction that a crash interrupted.
+    Batches are acknowledged in spool order, but lanes of a dispatcher
+    deliver them out of order, so the cursor also keeps the highest
+    sequence delivered for every `ordering_key` past the acknowledged
+    offset; `delivered` tells a replay which records were already sent
+    after something that came before them.
+    """
+
+    def __init__(self, path, max_bytes=64 * 1024 * 1024,
+                 compact_bytes=8 * 1024 * 1024):
+        self.path = path
+        self.offset_path = path + ".offset"
+        self.compact_path = path + ".compact"
+        self.max_bytes = max_bytes
+        self.compact_bytes = compact_bytes
+        self.lock = threading.Condition(threading.Lock())
+        # Serializes cursor writes, which happen outside `lock`
+        self.cursor_lock = threading.Lock()
+        self.in_flight = []
+        self.closed = False
+        # Bytes appended and fsync'd since opening, for group commit
+        self.written = 0
+        self.synced = 0
+        self.syncing = False
+        self._open()
+
+    def _open(self):
+        generation, committed, self.high_water = self._read_offset()
+        if os.path.exists(self.compact_path):
+            if self._read_generation(self.compact_path) == generation:
+                # The cursor already points into the compacted file
+                os.rename(self.compact_path, self.path)
+            else:
+                os.remove(self.compact_path)
+
+        if not os.path.exists(self.path) or not os.path.getsize(self.path):
+            with open(self.path, "wb") as spool_file:
+                spool_file.write(SPOOL_HEADER.pack(SPOOL_MAGIC, 0))
+        self.generation = self._read_generation(self.path)
+        if self.generation is None:
+            raise ValueError("{path} is not an event spool"
+                             .format(path=self.path))
+        self.writer = open(self.path, "r+b")
+        self.reader = open(self.path, "rb")
+        self.writer.seek(0, os.SEEK_END)
+        file_end = self.writer.tell()
+
+        if generation != self.generation:
+            # No cursor for this file: replay all of it
+            committed = SPOOL_HEADER.size
+            self.high_water = {}
+        self.committed = min(max(committed, SPOOL_HEADER.size), file_end)
+        self.read_offset = self.committed
+
+        # Drop a torn trailing record left behind by a crash mid-write
+        data_end = self._last_record_end(self.committed, file_end)
+        self.writer.truncate(data_end)
+        self.size = data_end
+        self.writer.seek(data_end)
+
+    def _last_record_end(self, pos, file_end):
+        self.sequence = 0
+        while pos + RECORD_HEADER.size <= file_end:
+            self.reader.seek(pos)
+            length, sequence = RECORD_HEADER.unpack(
+                self.reader.read(RECORD_HEADER.size))
+            if pos + RECORD_HEADER.size + length > file_end:
+                break
+            self.sequence = sequence
+            pos += RECORD_HEADER.size + length
+        return pos
+
+    @staticmethod
+    def _read_generation(path):
+        try:
+            with open(path, "rb") as spool_file:
+                magic, generation = SPOOL_HEADER.unpack(
+                    spool_file.read(SPOOL_HEADER.size))
+        except (IOError, struct.error):
+            return None
+        return generation if magic == SPOOL_MAGIC else None
+
+    def _read_offset(self):
+        try:
+            with open(self.offset_path, "r") as offset_file:
+                cursor = json.load(offset_file)
+            return (int(cursor["generation"]), int(cursor["offset"]),
+                    dict(cursor.get("delivered", {})))
+        except (IOError, ValueError, KeyError, TypeError):
+            return None, 0, {}
+
+    def _cursor(self, generation=None, offset=None):
+        return json.dumps({
+            "generation": self.generation if generation is None
+            else generation,
+            "offset": self.committed if offset is None else offset,
+            "delivered": self.high_water
+        })
+
+    def _save_cursor(self):
+        # Called with cursor_lock held, so appends can go on during
+        # the fsync while cursor writes still land in order
+        with self.lock:
+            cursor = self._cursor()
+        write_file_atomic(self.offset_path, cursor)
+
+    @staticmethod
+    def _high_water_key(event):
+        return json.dumps(ordering_key(event))
+
+    def delivered(self, event):
+        """Whether a later event with the same ordering key was sent"""
+        with self.lock:
+            return spool_sequence(event) <= self.high_water.get(
+                self._high_water_key(event), -1)
+
+    def mark_delivered(self, events):
+        with self.cursor_lock:
+            with self.lock:
+                for event in events:
+                    key = self._high_water_key(event)
+                    self.high_water[key] = max(self.high_water.get(key, -1),
+                                               spool_sequence(event))
+            self._save_cursor()
+
+    def pending(self):
+        with self.lock:
+            return self.size - self.committed
+
+    def append(self, api_key, event):
+        payload = encode_spool_record(api_key, event)
+        record_len = RECORD_HEADER.size + len(payload)
+        with self.lock:
+            if self.size - self.committed + record_len > self.max_bytes:
+                raise SpoolFull("spool holds {pending} undelivered bytes"
+                                .format(pending=self.size - self.committed))
+            # Microseconds since the epoch keep the sequence increasing
+            # even when the spool was emptied before a restart
+            self.sequence = max(self.sequence + 1,
+                                int(time.time() * 1000000))
+            self.writer.write(RECORD_HEADER.pack(len(payload),
+                                                 self.sequence))
+            self.writer.write(payload)
+            self.writer.flush()
+            self.size += record_len
+            self.written += record_len
+            self.lock.notify_all()
+            self._sync(self.written)
+
+    def _sync(self, written):
+        # Whoever finds no fsync running syncs everything written so
+        # far; the writers queued up behind it share that one fsync
+        while self.synced < written:
+            if self.syncing:
+                self.lock.wait()
+                continue
+            self.syncing = True
+            target = self.written
+            fileno = self.writer.fileno()
+            self.lock.release()
+            try:
+                os.fsync(fileno)
+            finally:
+                self.lock.acquire()
+                self.syncing = False
+                self.lock.notify_all()
+            self.synced = max(self.synced, target)
+
+    def _wait_for_sync(self):
+        while self.syncing:
+            self.lock.wait()
+
+    def next_batch(self, max_events, timeout=None):
+        with self.lock:
+            if self.read_offset >= self.size and not self.closed:
+                self.lock.wait(timeout)
+            if self.read_offset >= self.size:
+                return None
+
+            start = self.read_offset
+            records = []
+            self.reader.seek(start)
+            while len(records) < max_events and \
+                    self.reader.tell() < self.size:
+                length, sequence = RECORD_HEADER.unpack(
+                    self.reader.read(RECORD_HEADER.size))
+                records.append(decode_spool_record(self.reader.read(length),
+                                                   sequence))
+            batch = SpoolBatch(start, self.reader.tell(), records, sequence)
+            self.read_offset = batch.end
+            self.in_flight.append(batch)
+            return batch
+
+    def ack(self, batch):
+        with self.cursor_lock:
+            with self.lock:
+                batch.records = None
+                committed_sequence = None
+                while self.in_flight and self.in_flight[0].records is None:
+                    done = self.in_flight.pop(0)
+                    self.committed = done.end
+                    committed_sequence = done.sequence
+                if committed_sequence is not None:
+                    # Nothing left to replay is that old any more
+                    self.high_water = dict(
+                        (key, sequence)
+                        for key, sequence in self.high_water.items()
+                        if sequence > committed_sequence)
+                compact = self.committed - SPOOL_HEADER.size >= \
+                    self.compact_bytes
+            if compact:
+                self._compact()
+            else:
+                self._save_cursor()
+
+    def _compact(self):
+        # Rewrite the undelivered tail to the front of a fresh file so
+        # the spool doesn't grow forever under steady load. Called with
+        # cursor_lock held, so `committed` stays put; the tail is copied
+        # without `lock` and only what was appended meanwhile under it
+        with self.lock:
+            start = self.committed
+            end = self.size
+            generation = self.generation + 1
+        with open(self.compact_path, "wb") as compacted, \
+                open(self.path, "rb") as source:
+            compacted.write(SPOOL_HEADER.pack(SPOOL_MAGIC, generation))
+            source.seek(start)
+            copy_bytes(source, compacted, end - start)
+            compacted.flush()
+            os.fsync(compacted.fileno())
+
+            with self.lock:
+                if self.closed:
+                    compacted.close()
+                    os.remove(self.compact_path)
+                    return
+                self._wait_for_sync()
+                copy_bytes(source, compacted, self.size - end)
+                compacted.flush()
+                os.fsync(compacted.fileno())
+                # From here on a restart completes the rename itself
+                write_file_atomic(self.offset_path,
+                                  self._cursor(generation, SPOOL_HEADER.size))
+                self.writer.close()
+                self.reader.close()
+                os.rename(self.compact_path, self.path)
+                self.generation = generation
+                # The compacted file was fsync'd with everything written
+                self.synced = self.written
+                self.writer = open(self.path, "r+b")
+                self.writer.seek(0, os.SEEK_END)
+                self.reader = open(self.path, "rb")
+
+                shift = start - SPOOL_HEADER.size
+                for batch in self.in_flight:
+                    batch.start -= shift
+                    batch.end -= shift
+                self.size -= shift
+                self.read_offset -= shift
+                self.committed = SPOOL_HEADER.size
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.lock.notify_all()
+            self._wait_for_sync()
+            self.writer.close()
+            self.reader.close()
+
+
+class CollectorClient(object):
+    """
+    POSTs events for one dispatcher worker, reporting the HTTP status
+    along with the result so the caller can tell what is worth retrying.
+    The connection is kept open between requests, so a busy worker
+    doesn't do a TLS handshake for every batch.
+    """
+
+    def __init__(self, signifai_host="collectors.signifai.io",
+                 signifai_port=http_client.HTTPS_PORT,
+                 signifai_uri=DEFAULT_POST_URI,
+                 timeout=5,
+                 attempts=5,
+                 httpsconn=http_client.HTTPSConnection):
+        self.signifai_host = signifai_host
+        self.signifai_port = signifai_port
+        self.signifai_uri = signifai_uri
+        self.timeout = timeout
+        self.attempts = attempts
+        self.httpsconn = httpsconn
+        self.conn = None
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def post(self, auth_key, data, body=None):
+        bugsnag_metadata = {
+            "data": data,
+            "signifai_host": self.signifai_host,
+            "signifai_port": self.signifai_port,
+            "signifai_uri": self.signifai_uri,
+            "timeout": self.timeout,
+            "attempts": self.attempts,
+            "httpsconn_class": self.httpsconn.__name__
+        }
+        if self.conn is not None:
+            result, status = POST_to_client(self.conn, auth_key, data,
+                                            self.signifai_uri,
+                                            bugsnag_metadata, body,
+                                            report_errors=False)
+            if status is not None:
+                return result, status
+            # The collector may have closed the idle connection; try
+            # once more on a fresh one before reporting a failure
+            self.close()
+
+        self.conn = HTTP_connect(self.signifai_host, self.signifai_port,
+                                 bugsnag_metadata, self.timeout,
+                                 self.attempts, self.httpsconn)
+        if self.conn is None:
+            logging.getLogger("http_post").fatal(
+                "Could not connect successfully after {attempts} attempts"
+                .format(attempts=self.attempts))
+            bugsnag_notify(socket.timeout, bugsnag_metadata)
+            return False, None
+        result, status = POST_to_client(self.conn, auth_key, data,
+                                        self.signifai_uri, bugsnag_metadata,
+                                        body)
+        if status is None:
+            self.close()
+        return result, status
+
+
+class SpoolDispatcher(object):
+    """
+    Reads batches off an EventSpool and POSTs them to the collector
+    from a fixed pool of worker threads. Every worker owns a lane, and
+    all events with the same `ordering_key` go through the same lane, so
+    a trigger's events are delivered one after the other in spool order
+    while unrelated triggers are sent in parallel. A batch is only
+    acknowledged once the collector accepted all of it (or rejected its
+    events outright); transport failures and 5xx/429 answers are retried
+    with backoff, holding up only that lane. Other errors will not go
+    away by resending, so those events are appended to `dead_letter`
+    (when given) and dropped.
+    """
+
+    def __init__(self, spool, workers=4, batch_size=100, retry_delay=1.0,
+                 max_retry_delay=60.0, max_body_bytes=DEFAULT_MAX_BODY_BYTES,
+                 dead_letter=None, **post_kwargs):
+        self.spool = spool
+        self.workers = workers
+        self.batch_size = batch_size
+        self.max_body_bytes = max_body_bytes
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.dead_letter = dead_letter
+        self.post_kwargs = post_kwargs
+        self.lanes = [queue.Queue(2) for _ in range(workers)]
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.threads = []
+
+    def start(self):
+        feeder = threading.Thread(target=self._feed, name="spool-feeder")
+        self.threads.append(feeder)
+        for lane in range(self.workers):
+            self.threads.append(threading.Thread(
+                target=self._work, args=(self.lanes[lane],),
+                name="spool-worker-{num}".format(num=lane)))
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def stop(self, timeout=None):
+        self.stopping.set()
+        with self.spool.lock:
+            self.spool.lock.notify_all()
+        for thread in self.threads:
+            thread.join(timeout)
+        self.threads = []
+
+    def _put(self, lane, job):
+        while not self.stopping.is_set():
+            try:
+                lane.put(job, timeout=0.5)
+            except queue.Full:
+                continue
+            return True
+        return False
+
+    def _feed(self):
+        while not self.stopping.is_set():
+            batch = self.spool.next_batch(self.batch_size, timeout=0.5)
+            if batch is None:
+                continue
+
+            parts = [[] for _ in self.lanes]
+            for record in batch.records:
+                if self.spool.delivered(record[1]):
+                    # Sent before a restart, after records that were
+                    # still unacknowledged; sending it again would put
+                    # it after newer events
+                    continue
+                lane = hash(ordering_key(record[1])) % len(self.lanes)
+                parts[lane].append(record)
+            jobs = [(self.lanes[lane], part)
+                    for lane, part in enumerate(parts) if part]
+            batch.remaining = len(jobs)
+            if not jobs:
+                self.spool.ack(batch)
+            for lane, part in jobs:
+                if not self._put(lane, (batch, part)):
+                    break
+        for lane in self.lanes:
+            lane.put(None)
+
+    def _work(self, lane):
+        client = CollectorClient(**self.post_kwargs)
+        gave_up = False
+        while True:
+            job = lane.get()
+            if job is None:
+                client.close()
+                return
+            batch, records = job
+            # Once a job was given up on, later ones in the lane must not
+            # be sent ahead of it; they're all replayed after a restart
+            gave_up = gave_up or not self._try_deliver(client, records)
+            if not gave_up:
+                with self.lock:
+                    batch.remaining -= 1
+                    done = batch.remaining == 0
+                if done:
+                    self.spool.ack(batch)
+
+    def _try_deliver(self, client, records):
+        try:
+            return self._deliver(client, records)
+        except Exception as exc:
+            # Whatever went wrong would most likely go wrong again on a
+            # retry, so drop the events rather than lose the lane
+            logging.getLogger("http_post").fatal(
+                "Unexpected error delivering {count} events; dropping them"
+                .format(count=len(records)), exc_info=True)
+            bugsnag_notify(exc, {"events": len(records)})
+            client.close()
+            for api_key, event in records:
+                if self.spool.delivered(event):
+                    continue
+                try:
+                    self._dead_letter(api_key, None, [event])
+                except Exception:
+                    logging.getLogger("http_post").error(
+                        "Couldn't dead-letter event", exc_info=True)
+            return True
+
+    def _deliver(self, client, records):
+        log = logging.getLogger("http_post")
+        # One POST per run of events sharing an API key
+        groups = []
+        for api_key, event in records:
+            if groups and groups[-1][0] == api_key:
+                groups[-1][1].append(event)
+            else:
+                groups.append((api_key, [event]))
+
+        for api_key, events in groups:
+            for sub_batch, body in split_batches(events, self.max_body_bytes):
+                delay = self.retry_delay
+                while True:
+                    result, status = client.post(api_key,
+                                                 {"events": sub_batch},
+                                                 body=body)
+                    if not should_retry(result, status):
+                        # None means the collector refused the events;
+                        # resending them won't change its mind
+                        if result is False:
+                            log.error("Collector answered {status}; dropping "
+                                      "{count} events".format(
+                                          status=status,
+                                          count=len(sub_batch)))
+                            self._dead_letter(api_key, status, sub_batch)
+                        break
+                    log.info("Delivery failed; retrying in {delay}s"
+                             .format(delay=delay))
+                    if self.stopping.wait(delay):
+                        return False
+                    delay = min(delay * 2, self.max_retry_delay)
+                self.spool.mark_delivered(sub_batch)
+        return True
+
+    def _dead_letter(self, api_key, status, events):
+        if self.dead_letter is None:
+            return
+        lines = [dumps_json({"api_key": api_key, "status": status,
+                             "event": event.to_dict()}) + b"\n"
+                 for event in events]
+        with self.lock:
+            with open(self.dead_letter, "ab") as dead_letter:
+                dead_letter.writelines(lines)
+
+
+def parse_ingest_body(body, content_type=""):
+    text = body.decode("utf-8").replace("\r\n", "\n").strip()
+    if "json" in content_type or text.startswith("{"):
+        data = json.loads(text)
+        if not isinstance(data, dict):
+            raise ValueError("JSON body must be an object")
+        return dict((k, v if isinstance(v, string_types) else str(v))
+                    for k, v in data.items())
+    return parse_zabbix_msg(text)
+
+
+class IngestRequestHandler(http_server.BaseHTTPRequestHandler):
+    # Don't let a slow client hold one of the pool's threads forever
+    timeout = 10
+
+    def _respond(self, status, body, headers=None):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for header, value in (headers or {}).items():
+            self.send_header(header, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+        except ValueError:
+            length = 0
+        if length <= 0:
+            return self._respond(411, {"success": False,
+                                       "error": "Content-Length required"})
+        if length > self.server.max_body:
+            return self._respond(413, {"success": False,
+                                       "error": "body too large"})
+        body = self.rfile.read(length)
+
+        api_key = self.server.api_key
+        auth = self.headers.get("Authorization") or ""
+        if auth.startswith("Bearer "):
+            api_key = auth[len("Bearer "):].strip()
+
+        try:
+            msg_data = parse_ingest_body(
+                body, self.headers.get("Content-Type") or "")
+            if '_API_KEY' in msg_data:
+                api_key = msg_data.pop('_API_KEY')
+            REST_event = prepare_REST_event(msg_data, self.server.mapping)
+            if self.server.enricher is not None:
+                self.server.enricher.lookup(REST_event)
+            truncate_event(REST_event, self.server.max_attr_bytes,
+                           self.server.max_event_bytes,
+                           keep=self.server.untruncated_keys)
+        except (ValueError, KeyError, UnicodeDecodeError) as val_err:
+            return self._respond(400, {
+                "success": False,
+                "error": "Error validating/preparing event: {msg}"
+                         .format(msg=val_err)})
+        if not api_key:
+            return self._respond(401, {"success": False,
+                                       "error": "no API key given"})
+
+        try:
+            self.server.spool.append(api_key, REST_event)
+        except SpoolFull:
+            return self._respond(503, {"success": False,
+                                       "error": "spool full"},
+                                 {"Retry-After": "5"})
+        except (IOError, OSError) as exc:
+            logging.getLogger("ingest").fatal("Couldn't spool event",
+                                              exc_info=True)
+            bugsnag_notify(exc, {"original_message": body})
+            return self._respond(500, {"success": False,
+                                       "error": "couldn't spool event"})
+        return self._respond(202, {"success": True})
+
+    def log_message(self, format, *args):
+        logging.getLogger("ingest").debug(format, *args)
+
+
+class IngestServer(http_server.HTTPServer):
+    """
+    HTTP server for Zabbix webhook media types. Requests are handled
+    by a fixed pool of threads fed from a bounded queue; connections
+    arriving while the queue is full are dropped rather than letting
+    memory grow with the number of clients.
+    """
+
+    request_queue_size = 1024
+    allow_reuse_address = True
+
+    def __init__(self, server_address, spool, api_key=None, threads=32,
+                 backlog=1024, max_body=1024 * 1024, mapping=None,
+                 max_attr_bytes=DEFAULT_MAX_ATTR_BYTES,
+                 max_event_bytes=DEFAULT_MAX_EVENT_BYTES, enricher=None,
+                 handler=IngestRequestHandler):
+        http_server.HTTPServer.__init__(self, server_address, handler)
+        self.spool = spool
+        self.api_key = api_key
+        self.mapping = mapping
+        self.untruncated_keys = untruncated_keys(mapping)
+        self.enricher = enricher
+        self.max_attr_bytes = max_attr_bytes
+        self.max_event_bytes = max_event_bytes
+        self.max_body = max_body
+        self.pending_requests = queue.Queue(backlog)
+        self.pool = []
+        for thread_num in range(threads):
+            thread = threading.Thread(
+                target=self._handle_requests,
+                name="ingest-{num}".format(num=thread_num))
+            thread.daemon = True
+            thread.start()
+            self.pool.append(thread)
+
+    def process_request(self, request, client_address):
+        try:
+            self.pending_requests.put_nowait((request, client_address))
+        except queue.Full:
+            self.shutdown_request(request)
+
+    def _handle_requests(self):
+        while True:
+            item = self.pending_requests.get()
+            if item is None:
+                return
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def server_close(self):
+        http_server.HTTPServer.server_close(self)
+        for _ in self.pool:
+            self.pending_requests.put(None)
+        for thread in self.pool:
+            thread.join()
+
+
+def configure_daemon(bugsnag_key, log_names):
+    if bugsnag and bugsnag_key:
+        bugsnag.configure(
+            api_key=bugsnag_key,
+            project_root=os.path.abspath(os.path.dirname(__file__))
+        )
+
+    for name in log_names:
+        log = logging.getLogger(name)
+        log.addHandler(logging.StreamHandler(sys.stderr))
+        log.setLevel(20)
+
+
+def size_from_env(name, default):
+    """
+    The byte count in $`name` for script mode, which has no options to
+    take one from; `default` when it's unset or not a number
+    """
+    value = os.environ.get(name)
+    if not value:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        print("{name}={value} isn't a number of bytes; using {default}"
+              .format(name=name, value=value, default=default))
+        return default
+
+
+def add_size_arguments(parser):
+    parser.add_argument("--max-attr-bytes", type=int,
+                        default=DEFAULT_MAX_ATTR_BYTES,
+                        help="truncate longer attribute values; 0 disables")
+    parser.add_argument("--max-event-bytes", type=int,
+                        default=DEFAULT_MAX_EVENT_BYTES,
+                        help="shorten attributes of larger events; "
+                             "0 disables")
+    parser.add_argument("--max-body-bytes", type=int,
+                        default=DEFAULT_MAX_BODY_BYTES,
+                        help="split batches so requests stay under this")
+
+
+def ingest_main(argv):
+    parser = argparse.ArgumentParser(
+        prog="send_signifai.py --serve",
+        description="Accept Zabbix webhook alerts over HTTP and relay "
+                    "them to SignifAI in batches")
+    parser.add_argument("--listen", default="127.0.0.1:8080",
+                        help="address:port to listen on")
+    parser.add_argument("--spool", default="signifai.spool",
+                        help="path of the on-disk event spool")
+    parser.add_argument("--dead-letter", default=None,
+                        help="file events the collector refused are "
+                             "appended to (default: <spool>.dead)")
+    parser.add_argument("--api-key", default=None,
+                        help="API key used when a request doesn't carry one")
+    parser.add_argument("--bugsnag-key", default=None)
+    parser.add_argument("--threads", type=int, default=32)
+    parser.add_argument("--workers", type=int, default=4,
+                        help="concurrent deliveries to the collector")
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--max-spool-bytes", type=int,
+                        default=64 * 1024 * 1024)
+    parser.add_argument("--mapping", default=None,
+                        help="attribute mapping config (JSON)")
+    parser.add_argument("--zabbix-url", default=None,
+                        help="Zabbix frontend URL to look host metadata "
+                             "up with")
+    parser.add_argument("--zabbix-user", default=None)
+    parser.add_argument("--zabbix-password", default=None)
+    parser.add_argument("--zabbix-api-token", default=None)
+    add_size_arguments(parser)
+    add_enrichment_arguments(parser)
+    args = parser.parse_args(argv)
+
+    configure_daemon(args.bugsnag_key, ("http_post", "ingest", "enrichment"))
+    api = None
+    if args.zabbix_url:
+        api = ZabbixAPI(args.zabbix_url, token=args.zabbix_api_token)
+        if args.zabbix_user:
+            try:
+                api.login(args.zabbix_user, args.zabbix_password)
+            except (ZabbixAPIError, http_client.HTTPException,
+                    socket.error) as api_err:
+                # Host lookups log in again once Zabbix is reachable
+                logging.getLogger("enrichment").warning(
+                    "Couldn't log in to Zabbix", exc_info=True)
+                bugsnag_notify(api_err, {"zabbix_url": args.zabbix_url})
+    enricher = build_enricher(args, api)
+    if enricher is not None:
+        enricher.prefetch()
+        enricher.cache.save()
+        enricher.start(interval=min(60, args.host_cache_ttl / 4))
+
+    host, _, port = args.listen.rpartition(":")
+    spool = EventSpool(args.spool, max_bytes=args.max_spool_bytes)
+    dispatcher = SpoolDispatcher(spool, workers=args.workers,
+                                 batch_size=args.batch_size,
+                                 max_body_bytes=args.max_body_bytes,
+                                 dead_letter=args.dead_letter or
+                                 args.spool + ".dead")
+    mapping = load_mapping(args.mapping) if args.mapping \
+        else default_mapping()
+    server = IngestServer((host, int(port)), spool, api_key=args.api_key,
+                          threads=args.threads, mapping=mapping,
+                          max_attr_bytes=args.max_attr_bytes,
+                          max_event_bytes=args.max_event_bytes,
+                          enricher=enricher)
+    dispatcher.start()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        dispatcher.stop()
+        spool.close()
+        if enricher is not None:
+            enricher.stop()
+    return 0
+
+
+class ZabbixAPIError(Exception):
+    # What Zabbix versions say when a session or token isn't valid (any
+    # more); logging in again is the only way out of those
+    AUTH_MESSAGES = ("not authorised", "not authorized", "re-login",
+                     "session terminated", "token expired")
+
+    @property
+    def auth_failed(self):
+        message = str(self).lower()
+        return any(m in message for m in self.AUTH_MESSAGES)
+
+
+class ZabbixAPI(object):
+    """
+    Minimal Zabbix JSON-RPC client. One connection is kept open across
+    calls so paging through events doesn't reconnect for every page;
+    calls are serialized on it, so threads can share a client. Once
+    login() was called, a call refused because the session expired
+    logs in again and is retried once.
+    """
+
+    def __init__(self, url, token=None, bearer=False, timeout=30):
+        parts = urlsplit(url)
+        if parts.scheme == "https":
+            self.conn_class = http_client.HTTPSConnection
+        else:
+            self.conn_class = http_client.HTTPConnection
+        self.host = parts.hostname
+        self.port = parts.port
+        self.path = parts.path or "/"
+        if not self.path.endswith(".php"):
+            self.path = self.path.rstrip("/") + "/api_jsonrpc.php"
+        self.token = token
+        self.bearer = bearer
+        self.timeout = timeout
+        self.client = None
+        self.request_id = 0
+        self.credentials = None
+        self.lock = threading.RLock()
+
+    def close(self):
+        with self.lock:
+            if self.client is not None:
+                self.client.close()
+                self.client = None
+
+    def call(self, method, params=None):
+        with self.lock:
+            try:
+                return self._call(method, params)
+            except ZabbixAPIError as exc:
+                if (self.credentials is None or method == "user.login" or
+                        not exc.auth_failed):
+                    raise
+            self.login(*self.credentials)
+            return self._call(method, params)
+
+    def _call(self, method, params):
+        self.request_id += 1
+        request = {
+            "jsonrpc": "2.0",
+            "method": method,
+            "params": params if params is not None else {},
+            "id": self.request_id
+        }
+        headers = {"Content-Type": "application/json-rpc"}
+        if self.token and method not in ("user.login", "apiinfo.version"):
+            if self.bearer:
+                headers["Authorization"] = "Bearer {token}".format(
+                    token=self.token)
+            else:
+                request["auth"] = self.token
+        body = dumps_json(request)
+
+        for attempt in range(2):
+            if self.client is None:
+                self.client = self.conn_class(self.host, self.port,
+                                              timeout=self.timeout)
+            try:
+                self.client.request("POST", self.path, body=body,
+                                    headers=headers)
+                res = self.client.getresponse()
+                data = res.read()
+            except (http_client.HTTPException, socket.error):
+                # The server may have dropped our kept-alive connection;
+                # reconnect once before giving up
+                self.close()
+                if attempt:
+                    raise
+            else:
+                break
+
+        if res.status != 200:
+            raise ZabbixAPIError("HTTP {status} from Zabbix API"
+                                 .format(status=res.status))
+        try:
+            response = loads_json(data)
+        except ValueError:
+            raise ZabbixAPIError("Didn't receive valid JSON from Zabbix API")
+        if "error" in response:
+            error = response["error"]
+            raise ZabbixAPIError("{method}: {message} {data}".format(
+                method=method, message=error.get("message"),
+                data=error.get("data")))
+        return response["result"]
+
+    def login(self, user, password):
+        # Kept even if this login fails, so the next call tries again
+        self.credentials = (user, password)
+        try:
+            self.token = self.call("user.login", {"username": user,
+                                                  "password": password})
+        except ZabbixAPIError:
+            # Zabbix before 5.4 calls the parameter "user"
+            self.token = self.call("user.login", {"user": user,
+                                                  "password": password})
+        return self.token
+
+
+class EventCursor(object):
+    """
+    The last Zabbix eventid delivered to SignifAI, persisted to a file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.eventid = None
+        try:
+            with open(path, "r") as cursor_file:
+                self.eventid = int(cursor_file.read().strip())
+        except (IOError, ValueError):
+            pass
+
+    def save(self, eventid):
+        self.eventid = int(eventid)
+        write_file_atomic(self.path, str(self.eventid))
+
+
+def zabbix_event_to_msg(event):
+    """
+    Turn a trigger event from the event.get API into the same
+    macro -> value mapping parse_zabbix_msg produces from the
+    alert template in the README
+    """
+    trigger = event.get("relatedObject") or {}
+    hosts = event.get("hosts") or [{}]
+    clock = datetime.fromtimestamp(int(event["clock"]))
+    msg = {
+        "EVENT.ID": event["eventid"],
+        "EVENT.DATE": clock.strftime("%Y.%m.%d"),
+        "EVENT.TIME": clock.strftime("%H:%M:%S"),
+        "TRIGGER.STATUS": "PROBLEM" if str(event["value"]) == "1" else "OK",
+        "TRIGGER.ID": event.get("objectid") or trigger.get("triggerid"),
+        "TRIGGER.NAME": event.get("name") or trigger.get("description"),
+        "TRIGGER.DESCRIPTION": trigger.get("comments"),
+        "TRIGGER.NSEVERITY": trigger.get("priority") or event.get("severity"),
+        "TRIGGER.EXPRESSION": trigger.get("expression"),
+        "HOST.NAME": hosts[0].get("name") or hosts[0].get("host"),
+    }
+    # Leave out what the API didn't give us so prepare_REST_event
+    # reports it as missing
+    return dict((k, v if isinstance(v, string_types) else str(v))
+                for k, v in msg.items() if v is not None)
+
+
+class ZabbixEventPoller(object):
+    """
+    Pulls trigger events from the Zabbix API in pages of `page_size`,
+    starting after the eventid held by `cursor`, and POSTs each page to
+    the collector as one batch. The cursor only moves past a page once
+    it has been delivered.
+    """
+
+    def __init__(self, api, cursor, api_key, page_size=1000, backfill=False,
+                 mapping=None, max_attr_bytes=DEFAULT_MAX_ATTR_BYTES,
+                 max_event_bytes=DEFAULT_MAX_EVENT_BYTES, enricher=None,
+                 post=None, **post_kwargs):
+        self.api = api
+        self.cursor = cursor
+        self.api_key = api_key
+        self.page_size = page_size
+        self.backfill = backfill
+        self.mapping = mapping
+        self.untruncated_keys = untruncated_keys(mapping)
+        self.enricher = enricher
+        self.max_attr_bytes = max_attr_bytes
+        self.max_event_bytes = max_event_bytes
+        self.post = post or POST_events
+        self.post_kwargs = post_kwargs
+
+    def _event_params(self):
+        return {
+            "output": "extend",
+            "source": 0,
+            "object": 0,
+            "selectHosts": ["host", "name"],
+            "selectRelatedObject": ["triggerid", "description", "comments",
+                                    "expression", "priority"],
+            "sortfield": ["eventid"],
+        }
+
+    def latest_eventid(self):
+        params = self._event_params()
+        params.update({"sortorder": "DESC", "limit": 1})
+        events = self.api.call("event.get", params)
+        return int(events[0]["eventid"]) if events else 0
+
+    def fetch_page(self):
+        params = self._event_params()
+        params.update({
+            "sortorder": "ASC",
+            "limit": self.page_size,
+            "eventid_from": str((self.cursor.eventid or 0) + 1)
+        })
+        return self.api.call("event.get", params)
+
+    def poll_once(self):
+        """
+        Deliver every event newer than the cursor. Returns the number of
+        events sent, or None if the collector couldn't be reached.
+        """
+        log = logging.getLogger("zabbix_poll")
+        if self.cursor.eventid is None and not self.backfill:
+            # First run: don't replay the whole event history
+            self.cursor.save(self.latest_eventid())
+            return 0
+
+        sent = 0
+        while True:
+            page = self.fetch_page()
+            if not page:
+                break
+
+            events = []
+            for zabbix_event in page:
+                try:
+                    events.append(prepare_REST_event(
+                        zabbix_event_to_msg(zabbix_event), self.mapping))
+                except (ValueError, KeyError) as val_err:
+                    log.warning("Skipping event {eventid}: {msg}".format(
+                        eventid=zabbix_event.get("eventid"), msg=val_err))
+                    bugsnag_notify(val_err, {"zabbix_event": zabbix_event})
+            if self.enricher is not None:
+                # One host lookup for the whole page at most
+                try:
+                    self.enricher.enrich_all(events)
+                except Exception as exc:
+                    log.warning("Couldn't add host metadata", exc_info=True)
+                    bugsnag_notify(exc, {"events": len(events)})
+            encoded = [truncate_and_encode(event, self.max_attr_bytes,
+                                           self.max_event_bytes,
+                                           keep=self.untruncated_keys)
+                       for event in events]
+
+            if events:
+                result = self.post(self.api_key, events, encoded=encoded,
+                                   **self.post_kwargs)
+                if result is False:
+                    return None
+            self.cursor.save(page[-1]["eventid"])
+            sent += len(events)
+            if len(page) < self.page_size:
+                break
+        return sent
+
+
+DEFAULT_HOSTS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                  "signifai_hosts.json")
+
+
+def normalize_host(host):
+    """
+    Reduce a host from host.get or a configuration export to the
+    metadata we attach to events
+    """
+    groups = host.get("groups") or host.get("hostgroups") or []
+    inventory = host.get("inventory") or {}
+    if not isinstance(inventory, dict):
+        # The API returns [] when inventory is disabled for the host
+        inventory = {}
+    return {
+        "hostid": host.get("hostid"),
+        "groups": sorted(group["name"] for group in groups),
+        "inventory": dict((k, v) for k, v in inventory.items()
+                          if v and k != "hostid" and
+                          isinstance(v, string_types)),
+        "tags": [[tag["tag"], tag.get("value", "")]
+                 for tag in host.get("tags") or []]
+    }
+
+
+def host_attributes(metadata):
+    attributes = {}
+    if metadata.get("hostid"):
+        attributes["zabbix/host/id"] = metadata["hostid"]
+    if metadata.get("groups"):
+        attributes["zabbix/host/groups"] = str.join(", ", metadata["groups"])
+    for k, v in metadata.get("inventory", {}).items():
+        attributes["zabbix/host/inventory/{rekey}".format(
+            rekey=zabbix_key_to_signifai_key(k))] = v
+    for tag, value in metadata.get("tags", []):
+        attributes["zabbix/host/tags/{rekey}".format(
+            rekey=zabbix_key_to_signifai_key(tag))] = value
+    return attributes
+
+
+class HostMetadataCache(object):
+    """
+    LRU cache of host metadata whose entries expire `ttl` seconds after
+    they were fetched. With a `path` it's loaded from and saved to disk,
+    so separate invocations of the script share it.
+    """
+
+    def __init__(self, path=None, max_entries=10000, ttl=3600):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.dirty = False
+        if path:
+            self.load()
+
+    def load(self):
+        try:
+            with open(self.path, "r") as cache_file:
+                entries = json.load(cache_file)["entries"]
+        except (IOError, ValueError, KeyError, TypeError):
+            return
+        now = time.time()
+        with self.lock:
+            for name, expires, metadata in entries[-self.max_entries:]:
+                if expires > now:
+                    self.entries[name] = (expires, metadata)
+
+    def save(self):
+        with self.lock:
+            if not self.path or not self.dirty:
+                return
+            entries = [[name, expires, metadata]
+                       for name, (expires, metadata) in self.entries.items()]
+            self.dirty = False
+        try:
+            write_file_atomic(self.path, json.dumps({"entries": entries}))
+        except (IOError, OSError):
+            logging.getLogger("enrichment").warning(
+                "Couldn't save host cache", exc_info=True)
+
+    def get(self, name):
+        """
+        The cached metadata for `name`, or None when it's missing or
+        has expired
+        """
+        with self.lock:
+            entry = self.entries.pop(name, None)
+            if entry is None:
+                return None
+            if entry[0] <= time.time():
+                self.dirty = True
+                return None
+            self.entries[name] = entry
+            return entry[1]
+
+    def expiring(self, within):
+        """Names of the entries that expire in the next `within` seconds"""
+        deadline = time.time() + within
+        with self.lock:
+            return [name for name, (expires, _) in self.entries.items()
+                    if expires <= deadline]
+
+    def put(self, name, metadata):
+        with self.lock:
+            self.entries.pop(name, None)
+            self.entries[name] = (time.time() + self.ttl, metadata)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            self.dirty = True
+
+
+class ZabbixHostSource(object):
+    """
+    Looks host metadata up with host.get, by visible name
+    """
+
+    def __init__(self, api):
+        self.api = api
+        self.groups_param = "selectGroups"
+
+    def fetch(self, names=None):
+        params = {
+            "output": ["hostid", "host", "name"],
+            "selectInventory": "extend",
+            "selectTags": ["tag", "value"]
+        }
+        if names is not None:
+            params["filter"] = {"name": list(names)}
+        try:
+            params[self.groups_param] = ["name"]
+            hosts = self.api.call("host.get", params)
+        except ZabbixAPIError as exc:
+            if (self.groups_param != "selectGroups" or
+                    "selectGroups" not in str(exc)):
+                raise
+            # Zabbix 6.2 renamed it and 7.0 dropped the old name
+            params.pop(self.groups_param)
+            self.groups_param = "selectHostGroups"
+            params[self.groups_param] = ["name"]
+            hosts = self.api.call("host.get", params)
+        return dict((host.get("name") or host["host"], normalize_host(host))
+                    for host in hosts)
+
+
+class FileHostSource(object):
+    """
+    Reads host metadata from a JSON configuration export of the hosts
+    (Configuration -> Hosts -> Export in the frontend). The file is only
+    parsed the first time a host isn't found in the cache, and that
+    fetch returns every host in it so all of them get cached at once.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.hosts = None
+
+    def _load(self):
+        with open(self.path, "rb") as export_file:
+            data = loads_json(export_file.read())
+        if isinstance(data, dict):
+            data = data.get("zabbix_export", data).get("hosts", [])
+        self.hosts = {}
+        for host in data:
+            metadata = normalize_host(host)
+            self.hosts[host["host"]] = metadata
+            if host.get("name"):
+                self.hosts[host["name"]] = metadata
+
+    def fetch(self, names=None):
+        if self.hosts is None:
+            self._load()
+            return dict(self.hosts)
+        if names is None:
+            return dict(self.hosts)
+        return dict((name, self.hosts[name]) for name in names
+                    if name in self.hosts)
+
+
+class HostEnricher(object):
+    """
+    Adds host groups, inventory and tags to events as zabbix/host/...
+    attributes. Lookups go through `cache`; hosts missing from it are
+    fetched from `source` in one request per batch of events, and hosts
+    the source doesn't know are cached too so they aren't asked for
+    again until they expire.
+
+    Servers that can't wait on the source while answering a request
+    `start` a background thread instead and only `lookup` events: it
+    fetches the hosts those missed and refreshes entries in bulk before
+    they expire, saving the cache after each round rather than after
+    every miss.
+    """
+
+    def __init__(self, source, cache=None):
+        self.source = source
+        self.cache = cache if cache is not None else HostMetadataCache()
+        self.lock = threading.Lock()
+        self.wanted = set()
+        self.wake = threading.Event()
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def prefetch(self, names=None):
+        """
+        Fill the cache for `names`, or for every host the source knows
+        """
+        if names is not None:
+            names = set(n for n in names
+                        if n and self.cache.get(n) is None)
+            if not names:
+                return
+        self._fetch(names)
+
+    def _fetch(self, names):
+        try:
+            found = self.source.fetch(names)
+        except Exception as exc:
+            # Whatever the source choked on (a malformed host included),
+            # events still go out, just without host metadata
+            logging.getLogger("enrichment").warning(
+                "Couldn't fetch host metadata", exc_info=True)
+            bugsnag_notify(exc, {"hosts": sorted(names or [])})
+            return
+        # Sources may return more hosts than were asked for
+        for name, metadata in found.items():
+            self.cache.put(name, metadata)
+        for name in names or ():
+            if name not in found:
+                self.cache.put(name, {})
+
+    def enrich(self, event):
+        return self.enrich_all([event])[0]
+
+    def enrich_all(self, events):
+        self.prefetch(event.get("host") for event in events)
+        self.cache.save()
+        for event in events:
+            self.lookup(event)
+        return events
+
+    def lookup(self, event):
+        """
+        Enrich `event` from the cache alone; a host missing from it is
+        left for the background thread to fetch
+        """
+        host = event.get("host")
+        metadata = self.cache.get(host)
+        if metadata:
+            event["attributes"].update(host_attributes(metadata))
+        elif metadata is None and host and self.thread is not None:
+            with self.lock:
+                self.wanted.add(host)
+            self.wake.set()
+        return event
+
+    def refresh(self, within):
+        """
+        Fetch the hosts `lookup` missed and those expiring in the next
+        `within` seconds
+        """
+        with self.lock:
+            names, self.wanted = self.wanted, set()
+        names.update(self.cache.expiring(within))
+        if names:
+            self._fetch(names)
+
+    def start(self, interval=60):
+        self.thread = threading.Thread(target=self._refresh_forever,
+                                       args=(interval,),
+                                       name="host-refresh")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is not None:
+            self.stopping.set()
+            self.wake.set()
+            self.thread.join()
+            self.thread = None
+        self.cache.save()
+
+    def _refresh_forever(self, interval):
+        while not self.stopping.is_set():
+            self.wake.wait(interval)
+            self.wake.clear()
+            if self.stopping.is_set():
+                return
+            # Twice the interval, so entries are refreshed at least one
+            # round before they expire
+            self.refresh(interval * 2)
+            self.cache.save()
+
+
+def build_enricher(args, api=None):
+    """
+    An enricher for the --hosts-file/--host-cache command line options,
+    using `api` when no hosts file is given; None when neither is there
+    """
+    if args.hosts_file:
+        source = FileHostSource(args.hosts_file)
+    elif api is not None:
+        source = ZabbixHostSource(api)
+    else:
+        return None
+    return HostEnricher(source, HostMetadataCache(args.host_cache,
+                                                  ttl=args.host_cache_ttl))
+
+
+def add_enrichment_arguments(parser):
+    parser.add_argument("--hosts-file", default=None,
+                        help="JSON export of the Zabbix hosts to take "
+                             "host metadata from")
+    parser.add_argument("--host-cache", default=None,
+                        help="file to keep looked up host metadata in")
+    parser.add_argument("--host-cache-ttl", type=float, default=3600)
+
+
+def poll_main(argv):
+    parser = argparse.ArgumentParser(
+        prog="send_signifai.py --poll",
+        description="Pull trigger events from the Zabbix API and send "
+                    "them to SignifAI")
+    parser.add_argument("--api-url", required=True,
+                        help="Zabbix frontend URL, e.g. "
+                             "http://localhost/zabbix")
+    parser.add_argument("--user", default=None)
+    parser.add_argument("--password", default=None)
+    parser.add_argument("--api-token", default=None,
+                        help="Zabbix API token, instead of --user/--password")
+    parser.add_argument("--bearer-auth", action="store_true",
+                        help="send the token in an Authorization header "
+                             "(Zabbix 6.4+)")
+    parser.add_argument("--cursor", default="signifai.cursor",
+                        help="file holding the last delivered eventid")
+    parser.add_argument("--page-size", type=int, default=1000)
+    parser.add_argument("--interval", type=float, default=0,
+                        help="seconds between polls; 0 polls once and exits")
+    parser.add_argument("--backfill", action="store_true",
+                        help="without a cursor, send all past events "
+                             "instead of starting from the newest one")
+    parser.add_argument("--api-key", required=True)
+    parser.add_argument("--bugsnag-key", default=None)
+    parser.add_argument("--mapping", default=None,
+                        help="attribute mapping config (JSON)")
+    parser.add_argument("--enrich", action="store_true",
+                        help="attach host groups, inventory and tags from "
+                             "the Zabbix API (or --hosts-file)")
+    add_size_arguments(parser)
+    add_enrichment_arguments(parser)
+    args = parser.parse_args(argv)
+
+    configure_daemon(args.bugsnag_key,
+                     ("http_post", "zabbix_poll", "enrichment"))
+    log = logging.getLogger("zabbix_poll")
+
+    api = ZabbixAPI(args.api_url, token=args.api_token,
+                    bearer=args.bearer_auth)
+    mapping = load_mapping(args.mapping) if args.mapping \
+        else default_mapping()
+    enricher = None
+    if args.enrich or args.hosts_file:
+        enricher = build_enricher(args, api)
+    poller = ZabbixEventPoller(api, EventCursor(args.cursor), args.api_key,
+                               page_size=args.page_size,
+                               backfill=args.backfill, mapping=mapping,
+                               max_attr_bytes=args.max_attr_bytes,
+                               max_event_bytes=args.max_event_bytes,
+                               enricher=enricher,
+                               max_body_bytes=args.max_body_bytes)
+    while True:
+        result = None
+        try:
+            if api.token is None and args.user:
+                api.login(args.user, args.password)
+            result = poller.poll_once()
+        except (ZabbixAPIError, http_client.HTTPException,
+                socket.error) as api_err:
+            log.fatal("Couldn't fetch events from Zabbix", exc_info=True)
+            bugsnag_notify(api_err, {"api_url": args.api_url})
+            api.close()
+        if not args.interval:
+            return 0 if result is not None else 1
+        time.sleep(args.interval)
+
+
 def main(argv=sys.argv):
+    if len(argv) > 1 and argv[1] == "--serve":
+        return ingest_main(argv[2:])
+    if len(argv) > 1 and argv[1] == "--poll":
+        return poll_main(argv[2:])
+
     if len(argv) < 4:
         print("Required args 'to', 'subject' and 'message_body'")
         return 1
@@ -330,11 +2469,18 @@ def main(argv=sys.argv):
             project_root=project_root
         )
 
+    try:
+        mapping = default_mapping()
+    except (ValueError, IOError, OSError) as cfg_err:
+        print("Error loading attribute mapping: {msg}".format(msg=cfg_err))
+        bugsnag_notify(cfg_err, {"mapping_path": DEFAULT_MAPPING_PATH})
+        return 1
+
     try:
         msg_data = parse_zabbix_msg(message_data)
         if '_API_KEY' in msg_data:
             api_key = msg_data.pop('_API_KEY')
-        REST_event = prepare_REST_event(msg_data)
+        REST_event = prepare_REST_event(msg_data, mapping)
     except (ValueError, KeyError) as val_err:
         print("Error validating/preparing event: {msg}".format(msg=val_err))
         bugsnag_notify(val_err, {
@@ -342,6 +2488,23 @@ def main(argv=sys.argv):
         })
         return 1
 
+    if os.path.exists(DEFAULT_HOSTS_PATH):
+        try:
+            enricher = HostEnricher(
+                FileHostSource(DEFAULT_HOSTS_PATH),
+                HostMetadataCache(DEFAULT_HOSTS_PATH + ".cache"))
+            enricher.enrich(REST_event)
+        except Exception as exc:
+            # Better to send the alert without host metadata than not at all
+            print("Couldn't add host metadata: {msg}".format(msg=exc))
+            bugsnag_notify(exc, {"hosts_path": DEFAULT_HOSTS_PATH})
+    truncate_event(REST_event,
+                   size_from_env("SIGNIFAI_MAX_ATTR_BYTES",
+                                 DEFAULT_MAX_ATTR_BYTES),
+                   size_from_env("SIGNIFAI_MAX_EVENT_BYTES",
+                                 DEFAULT_MAX_EVENT_BYTES),
+                   keep=untruncated_keys(mapping))
+
     l = logging.getLogger("http_post")
     l.addHandler(logging.StreamHandler(sys.stderr))
     l.setLevel(20)
@@ -23,7 +23,12 @@ import functools
 import json
 import logging
 import os
+import random
+import shutil
 import socket
+import sys
+import tempfile
+import threading
 import time
 import unittest
 
@@ -36,6 +41,22 @@ except ImportError:
     # Python 2.7
     import httplib as http_client
 
+try:
+    # Python 3.6
+    import http.server as http_server
+    import socketserver
+except ImportError:
+    # Python 2.7
+    import BaseHTTPServer as http_server
+    import SocketServer as socketserver
+
+try:
+    # Python 3.6
+    import tracemalloc
+except ImportError:
+    # Python 2.7
+    tracemalloc = None
+
 try:
     # Python 3.6
     import unittest.mock as unittest_mock
@@ -280,7 +301,7 @@ class TestHTTPPost(unittest.TestCase):
 
         def request_gen_test(method, uri, body, headers):
             test_case.assertEqual(uri, send_signifai.DEFAULT_POST_URI)
-            test_case.assertEqual(body, json.dumps(test_case.events))
+            test_case.assertEqual(json.loads(body), test_case.events)
             test_case.assertEqual(headers['Authorization'],
                                   "Bearer {KEY}".format(KEY=API_KEY))
             test_case.assertEqual(headers['Content-Type'],
@@ -471,5 +492,1517 @@ class TestPrepareRESTEvent(unittest.TestCase):
         })
 
 
+class TestMapping(unittest.TestCase):
+    CONFIG = {
+        "attributes": {
+            "TRIGGER.ID": {"dest": "application"},
+            "HOST.NAME": {"dest": "host"},
+            "TRIGGER.STATUS": {
+                "dest": "state",
+                "placement": "attributes",
+                "map": {"problem": "alarm", "ok": "ok"}
+            },
+            "TRIGGER.NSEVERITY": {
+                "dest": "value",
+                "map": {"0": "low", "5": "critical"}
+            },
+            "HOST.IP": {"dest": "zabbix/host/ip", "required": False},
+            "EVENT.SOURCE": {"dest": "service", "default": "zabbix-server"}
+        }
+    }
+    EVENT = {
+        "TRIGGER.ID": "1515",
+        "HOST.NAME": "testhost01.zabbix.net",
+        "TRIGGER.STATUS": "PROBLEM",
+        "TRIGGER.NSEVERITY": "5",
+        "TRIGGER.NAME": "boopHost"
+    }
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.config_path = os.path.join(self.tmpdir, "mapping.json")
+        self.write_config(self.CONFIG)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write_config(self, config):
+        with open(self.config_path, "w") as config_file:
+            json.dump(config, config_file)
+
+    def test_builtin_mapping_matches_constants(self):
+        plan = send_signifai.BUILTIN_MAPPING
+        self.assertEqual(plan.required, set(send_signifai.ATTR_MAP))
+        self.assertEqual(plan.entries["TRIGGER.STATUS"],
+                         ("state", True, {"PROBLEM": "alarm", "OK": "ok"}))
+        self.assertEqual(plan.entries["HOST.NAME"], ("host", False, None))
+
+    def test_configured_mapping(self):
+        plan = send_signifai.load_mapping(self.config_path)
+        j = send_signifai.prepare_REST_event(self.EVENT, plan)
+        self.assertEqual(j["application"], "1515")
+        self.assertEqual(j["value"], "critical")
+        self.assertEqual(j["service"], "zabbix-server")
+        self.assertEqual(j["attributes"]["state"], "alarm")
+        # Not mapped, so it keeps the zabbix/ prefix
+        self.assertEqual(j["attributes"]["zabbix/trigger/name"], "boopHost")
+        self.assertNotIn("zabbix/host/ip", j["attributes"])
+
+    def test_optional_attribute(self):
+        plan = send_signifai.load_mapping(self.config_path)
+        event = dict(self.EVENT)
+        event["HOST.IP"] = "10.0.0.1"
+        event["EVENT.SOURCE"] = "proxy01"
+        j = send_signifai.prepare_REST_event(event, plan)
+        self.assertEqual(j["attributes"]["zabbix/host/ip"], "10.0.0.1")
+        self.assertEqual(j["service"], "proxy01")
+
+    def test_missing_required_attribute(self):
+        plan = send_signifai.load_mapping(self.config_path)
+        event = dict(self.EVENT)
+        event.pop("HOST.NAME")
+        with self.assertRaises(ValueError):
+            send_signifai.prepare_REST_event(event, plan)
+
+    def test_invalid_config(self):
+        bad_configs = [
+            [],
+            {"attributes": {"HOST.NAME": {}}},
+            {"attributes": {"HOST.NAME": {"dest": "host", "bogus": 1}}},
+            {"attributes": {"HOST.NAME": {"dest": "host",
+                                          "placement": "nowhere"}}},
+            {"attributes": {"HOST.NAME": {"dest": "host", "map": []}}},
+        ]
+        for config in bad_configs:
+            with self.assertRaises(ValueError):
+                send_signifai.compile_mapping(config)
+
+    def test_cached_plan_skips_compile(self):
+        send_signifai.load_mapping(self.config_path)
+        self.assertTrue(os.path.exists(self.config_path + ".cache"))
+        with unittest_mock.patch.object(send_signifai,
+                                        "compile_mapping") as compile_call:
+            plan = send_signifai.load_mapping(self.config_path)
+            # Same content, new mtime: only the hash gets checked
+            os.utime(self.config_path, (0, 0))
+            plan = send_signifai.load_mapping(self.config_path)
+        self.assertEqual(compile_call.call_count, 0)
+        self.assertEqual(plan.entries["TRIGGER.ID"],
+                         ("application", False, None))
+
+    def rewrite_cache(self, **changes):
+        cache_path = self.config_path + ".cache"
+        with open(cache_path) as cache_file:
+            cached = json.load(cache_file)
+        cached.update(changes)
+        with open(cache_path, "w") as cache_file:
+            json.dump(cached, cache_file)
+
+    def test_cache_from_other_version_is_recompiled(self):
+        send_signifai.load_mapping(self.config_path)
+        self.rewrite_cache(format=send_signifai.MAPPING_PLAN_FORMAT + 1,
+                           plan={"entries": {}, "required": [],
+                                 "defaults": []})
+        with unittest_mock.patch.object(
+                send_signifai, "compile_mapping",
+                wraps=send_signifai.compile_mapping) as compile_call:
+            plan = send_signifai.load_mapping(self.config_path)
+        self.assertEqual(compile_call.call_count, 1)
+        self.assertIn("TRIGGER.ID", plan.entries)
+
+    def test_malformed_cached_plan_is_recompiled(self):
+        send_signifai.load_mapping(self.config_path)
+        self.rewrite_cache(plan={"entries": {"TRIGGER.ID": ["application"]},
+                                 "required": [], "defaults": []})
+        # Force the SHA-1 check
+        os.utime(self.config_path, (0, 0))
+        plan = send_signifai.load_mapping(self.config_path)
+        self.assertEqual(plan.entries["TRIGGER.ID"],
+                         ("application", False, None))
+
+    def test_changed_config_is_recompiled(self):
+        send_signifai.load_mapping(self.config_path)
+        config = json.loads(json.dumps(self.CONFIG))
+        config["attributes"]["TRIGGER.ID"]["dest"] = "service"
+        config["attributes"].pop("EVENT.SOURCE")
+        self.write_config(config)
+        os.utime(self.config_path, (0, 0))
+        plan = send_signifai.load_mapping(self.config_path)
+        j = send_signifai.prepare_REST_event(self.EVENT, plan)
+        self.assertEqual(j["service"], "1515")
+
+
+class TestPayloadSize(unittest.TestCase):
+    def event(self, description="Something went wrong!"):
+        return send_signifai.prepare_REST_event(dict(
+            TestPrepareRESTEvent.BEST_CASE,
+            **{"TRIGGER.DESCRIPTION": description}))
+
+    def test_truncate_value(self):
+        marker = send_signifai.TRUNCATION_MARKER
+        self.assertEqual(send_signifai.truncate_value("short", 100), "short")
+        value = send_signifai.truncate_value("x" * 100, 50)
+        self.assertEqual(len(value), 50)
+        self.assertTrue(value.endswith(marker))
+
+    def test_truncate_value_multibyte(self):
+        # Never leave half a character behind
+        marker = send_signifai.TRUNCATION_MARKER
+        value = send_signifai.truncate_value(u"\u00e9" * 100, 51)
+        self.assertLessEqual(len(value.encode("utf-8")), 51)
+        self.assertEqual(value, u"\u00e9" * 18 + marker)
+
+    def test_truncate_value_never_exceeds_cap(self):
+        for max_bytes in range(0, 20):
+            value = send_signifai.truncate_value(
+                "abcdefghijklmnopqrstuvwxyz", max_bytes)
+            self.assertLessEqual(len(value), max_bytes)
+        self.assertEqual(send_signifai.truncate_value("abcdefghij", 5),
+                         "...[t")
+
+    def test_identity_fields_kept(self):
+        event = self.event("x" * 1000)
+        event["host"] = "h" * 1000
+        event["application"] = "a" * 1000
+        send_signifai.truncate_event(event, max_attr_bytes=100,
+                                     max_event_bytes=1000)
+        self.assertEqual(event["host"], "h" * 1000)
+        self.assertEqual(event["application"], "a" * 1000)
+        self.assertEqual(event["value"], "critical")
+        self.assertEqual(event["attributes"]["state"], "alarm")
+        self.assertEqual(len(event["attributes"]["annotations/description"]),
+                         len(send_signifai.TRUNCATION_MARKER))
+
+    def test_value_mapped_fields_kept(self):
+        mapping = send_signifai.compile_mapping({"attributes": {
+            "HOST.NAME": {"dest": "host"},
+            "TRIGGER.ID": {"dest": "application"},
+            "TRIGGER.NSEVERITY": {"dest": "value"},
+            "TRIGGER.DESCRIPTION": {"dest": "annotations/description"},
+            "ITEM.STATE": {"dest": "zabbix/item/state",
+                           "map": {"0": "normal " * 20}}
+        }})
+        event = send_signifai.prepare_REST_event(dict(
+            TestPrepareRESTEvent.BEST_CASE, **{"ITEM.STATE": "0"}), mapping)
+        send_signifai.truncate_event(
+            event, max_attr_bytes=50,
+            keep=send_signifai.untruncated_keys(mapping))
+        self.assertEqual(event["attributes"]["zabbix/item/state"],
+                         "normal " * 20)
+
+    def test_attribute_cap(self):
+        event = send_signifai.truncate_event(self.event("x" * 1000),
+                                             max_attr_bytes=100,
+                                             max_event_bytes=0)
+        description = event["attributes"]["annotations/description"]
+        self.assertEqual(len(description), 100)
+        self.assertEqual(event["host"], "testhost01.zabbix.net")
+
+    def test_event_cap(self):
+        event = send_signifai.truncate_event(self.event("x\n" * 5000),
+                                             max_attr_bytes=0,
+                                             max_event_bytes=2000)
+        self.assertLessEqual(len(send_signifai.dumps_json(event)), 2000)
+        self.assertEqual(event["attributes"]["alert/condition"],
+                         "errors >= 1")
+
+    def test_small_event_untouched(self):
+        event = self.event()
+        self.assertEqual(send_signifai.truncate_event(self.event()), event)
+
+    def test_split_batches(self):
+        events = [self.event("x" * i) for i in range(100)]
+        batches = list(send_signifai.split_batches(events, 2000))
+        self.assertGreater(len(batches), 1)
+        self.assertEqual([e for batch, body in batches for e in batch],
+                         events)
+        for batch, body in batches:
+            self.assertLessEqual(len(body), 2000)
+            self.assertEqual(json.loads(body), {"events": batch})
+
+    def test_split_batches_encodes_once(self):
+        events = [self.event() for _ in range(10)]
+        with unittest_mock.patch.object(send_signifai, "dumps_json",
+                                        wraps=send_signifai.dumps_json) as dumps:  # noqa
+            list(send_signifai.split_batches(events, 1000))
+        self.assertEqual(dumps.call_count, len(events))
+
+    def test_small_event_not_encoded(self):
+        with unittest_mock.patch.object(send_signifai, "dumps_json",
+                                        wraps=send_signifai.dumps_json) as dumps:  # noqa
+            send_signifai.truncate_event(self.event())
+        self.assertEqual(dumps.call_count, 0)
+
+    def test_size_bound(self):
+        event = self.event(u"Caf\u00e9 \"down\"\n\t\u2603\x00\U0001f600" * 10)
+        for name in send_signifai.SERIALIZERS:
+            send_signifai.use_serializer(name)
+            try:
+                self.assertGreaterEqual(send_signifai.json_size_bound(event),
+                                        len(send_signifai.dumps_json(event)))
+            finally:
+                send_signifai.use_serializer()
+
+    def test_truncated_encoding_reused(self):
+        events = [self.event() for _ in range(10)]
+        events.append(self.event("x" * 5000))
+        with unittest_mock.patch.object(send_signifai, "dumps_json",
+                                        wraps=send_signifai.dumps_json) as dumps:  # noqa
+            encoded = [send_signifai.truncate_and_encode(
+                e, max_event_bytes=2000) for e in events]
+            batches = list(send_signifai.split_batches(events, 100000,
+                                                       encoded))
+        # One encoding per event, and the oversized one once per cut
+        self.assertEqual(dumps.call_count, len(events) + 1)
+        self.assertEqual(json.loads(batches[0][1]), {"events": events})
+
+    def test_oversized_event_sent_alone(self):
+        logging.getLogger("http_post").setLevel(100)
+        events = [self.event(), self.event("x" * 5000), self.event()]
+        batches = list(send_signifai.split_batches(events, 1000))
+        self.assertEqual([len(batch) for batch, body in batches], [1, 1, 1])
+
+    def test_post_events_splits_requests(self):
+        logging.getLogger("http_post").setLevel(100)
+        collector = LocalCollector()
+        try:
+            events = [self.event("x" * 500) for _ in range(20)]
+            result = send_signifai.POST_events(
+                "TEST_API_KEY", events, max_body_bytes=4096,
+                **collector.post_kwargs)
+        finally:
+            collector.close()
+        self.assertTrue(result)
+        self.assertEqual(collector.events, events)
+        self.assertGreater(len(collector.server.received), 1)
+
+    def test_size_from_env(self):
+        name = "SIGNIFAI_MAX_ATTR_BYTES"
+        with unittest_mock.patch.dict(os.environ, {name: "1024"}):
+            self.assertEqual(send_signifai.size_from_env(name, 10), 1024)
+        with unittest_mock.patch.dict(os.environ, {name: "0"}):
+            self.assertEqual(send_signifai.size_from_env(name, 10), 0)
+        with unittest_mock.patch.dict(os.environ, {name: "lots"}), \
+                unittest_mock.patch.object(sys, "stdout"):
+            self.assertEqual(send_signifai.size_from_env(name, 10), 10)
+        with unittest_mock.patch.dict(os.environ):
+            os.environ.pop(name, None)
+            self.assertEqual(send_signifai.size_from_env(name, 10), 10)
+
+
+class TestSerializers(unittest.TestCase):
+    def setUp(self):
+        logging.getLogger("http_post").setLevel(100)
+        self.events = [send_signifai.prepare_REST_event(dict(
+            TestPrepareRESTEvent.BEST_CASE, **{
+                "EVENT.ID": str(i),
+                "TRIGGER.DESCRIPTION": u"Caf\u00e9 \"down\"\n\t\u2603"
+            })) for i in range(50)]
+
+    def tearDown(self):
+        send_signifai.use_serializer()
+
+    def test_stdlib_always_available(self):
+        self.assertIn("stdlib", send_signifai.SERIALIZERS)
+
+    def test_unknown_serializer(self):
+        with self.assertRaises(ValueError):
+            send_signifai.use_serializer("nope")
+
+    def test_unavailable_environment_serializer(self):
+        # e.g. SIGNIFAI_JSON=ujson left over after ujson was uninstalled
+        with unittest_mock.patch.dict(os.environ, {"SIGNIFAI_JSON": "nope"}):
+            send_signifai.use_serializer()
+        self.assertEqual(send_signifai.JSON_SERIALIZER, "stdlib")
+
+    def test_ujson_keeps_slashes(self):
+        with unittest_mock.patch.object(send_signifai, "ujson") as ujson:
+            ujson.dumps.return_value = "{}"
+            send_signifai._ujson_dumps({"uri": "/api/v1"})
+        ujson.dumps.assert_called_once_with({"uri": "/api/v1"},
+                                            escape_forward_slashes=False)
+
+    def test_environment_override(self):
+        with unittest_mock.patch.dict(os.environ, {"SIGNIFAI_JSON": "stdlib"}):
+            send_signifai.use_serializer()
+        self.assertEqual(send_signifai.JSON_SERIALIZER, "stdlib")
+
+    def test_collector_receives_same_payload(self):
+        """
+        Whatever serializer is installed, the collector has to decode
+        exactly the events the stdlib would have sent
+        """
+        for name in send_signifai.SERIALIZERS:
+            send_signifai.use_serializer(name)
+            collector = LocalCollector()
+            try:
+                compact = [send_signifai.CompactEvent.from_dict(e)
+                           for e in self.events[:10]]
+                result = send_signifai.POST_events(
+                    "TEST_API_KEY", self.events + compact,
+                    max_body_bytes=4096, **collector.post_kwargs)
+            finally:
+                collector.close()
+            self.assertTrue(result, name)
+            self.assertEqual(collector.events,
+                             json.loads(json.dumps(self.events +
+                                                   self.events[:10])),
+                             name)
+
+    def test_loads_response(self):
+        response = json.dumps({"success": True, "failed_events": []})
+        for name in send_signifai.SERIALIZERS:
+            send_signifai.use_serializer(name)
+            self.assertEqual(send_signifai.loads_json(response),
+                             {"success": True, "failed_events": []})
+            self.assertEqual(
+                send_signifai.loads_json(response.encode("utf-8")),
+                {"success": True, "failed_events": []})
+            with self.assertRaises(ValueError):
+                send_signifai.loads_json("this is a bad response text")
+
+
+class TestCompactEvent(unittest.TestCase):
+    def event(self, **extra):
+        data = dict(TestPrepareRESTEvent.BEST_CASE)
+        data.update(extra)
+        return send_signifai.prepare_REST_event(data)
+
+    def test_round_trip(self):
+        event = self.event(**{"EVENT.ID": "42", "ODD KEY": u"caf\u00e9"})
+        compact = send_signifai.CompactEvent.from_dict(event)
+        self.assertEqual(compact.to_dict(), event)
+        self.assertEqual(json.loads(compact.to_json()), event)
+
+    def test_same_json(self):
+        event = self.event(**{"EVENT.ID": "42"})
+        compact = send_signifai.CompactEvent.from_dict(event)
+        self.assertEqual(compact.to_json(), send_signifai.dumps_json(event))
+
+    def test_encode_decode(self):
+        event = self.event(**{"EVENT.ID": "42", "ODD KEY": u"caf\u00e9\n"})
+        event["attributes"]["nested"] = {"a": [1, 2]}
+        encoded = send_signifai.CompactEvent.from_dict(event).encode()
+        decoded = send_signifai.CompactEvent.decode(encoded)
+        self.assertEqual(decoded.to_dict(), event)
+        self.assertEqual(decoded.to_dict()["timestamp"], 1515925860)
+
+    def test_keys_are_shared(self):
+        first = send_signifai.CompactEvent.from_dict(
+            self.event(**{"EVENT.ID": "1", "ODD KEY": "a"}))
+        second = send_signifai.CompactEvent.decode(
+            send_signifai.CompactEvent.from_dict(
+                self.event(**{"EVENT.ID": "2", "ODD KEY": "b"})).encode())
+        for key in ("zabbix/event/id", "zabbix/odd_key"):
+            first_key = first.attributes[first.attributes.index(key)]
+            second_key = second.attributes[second.attributes.index(key)]
+            self.assertIs(first_key, second_key)
+
+    def test_spool_record(self):
+        event = self.event()
+        record = send_signifai.encode_spool_record("TEST_API_KEY", event)
+        api_key, decoded = send_signifai.decode_spool_record(record)
+        self.assertEqual(api_key, "TEST_API_KEY")
+        self.assertEqual(decoded, event)
+
+        api_key, decoded = send_signifai.decode_spool_record(record, 7)
+        event["attributes"][send_signifai.SEQUENCE_ATTR] = 7
+        self.assertEqual(decoded, event)
+
+    @unittest.skipIf(tracemalloc is None, "needs tracemalloc")
+    def test_smaller_than_dicts(self):
+        events = [self.event(**{"EVENT.ID": str(i)}) for i in range(1000)]
+        tracemalloc.start()
+        base = tracemalloc.get_traced_memory()[0]
+        dicts = [json.loads(json.dumps(e)) for e in events]
+        dict_bytes = tracemalloc.get_traced_memory()[0] - base
+        del dicts
+        base = tracemalloc.get_traced_memory()[0]
+        compact = [send_signifai.CompactEvent.decode(
+            send_signifai.CompactEvent.from_dict(e).encode())
+            for e in events]
+        compact_bytes = tracemalloc.get_traced_memory()[0] - base
+        tracemalloc.stop()
+        self.assertLess(compact_bytes, dict_bytes)
+
+
+class TestEventSpool(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "spool")
+        self.event = send_signifai.prepare_REST_event(
+            TestPrepareRESTEvent.BEST_CASE)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_torn_record_dropped(self):
+        spool = send_signifai.EventSpool(self.path)
+        spool.append("TEST_API_KEY", self.event)
+        spool.append("TEST_API_KEY", self.event)
+        spool.close()
+        with open(self.path, "r+b") as spool_file:
+            spool_file.truncate(os.path.getsize(self.path) - 3)
+
+        spool = send_signifai.EventSpool(self.path)
+        batch = spool.next_batch(10, timeout=0)
+        spool.close()
+        self.assertEqual(len(batch.records), 1)
+        api_key, event = batch.records[0]
+        event = event.to_dict()
+        event["attributes"].pop(send_signifai.SEQUENCE_ATTR)
+        self.assertEqual((api_key, event), ("TEST_API_KEY", self.event))
+
+    def test_sequence_increases_across_restarts(self):
+        spool = send_signifai.EventSpool(self.path)
+        spool.append("TEST_API_KEY", self.event)
+        spool.append("TEST_API_KEY", self.event)
+        spool.close()
+        spool = send_signifai.EventSpool(self.path)
+        spool.sequence += 10 ** 9
+        spool.append("TEST_API_KEY", self.event)
+        spool.close()
+        # The clock went backwards since the last record was written
+        with unittest_mock.patch.object(send_signifai.time, "time",
+                                        return_value=0):
+            spool = send_signifai.EventSpool(self.path)
+            spool.append("TEST_API_KEY", self.event)
+        batch = spool.next_batch(10, timeout=0)
+        spool.close()
+        sequences = [event.to_dict()["attributes"][
+            send_signifai.SEQUENCE_ATTR] for _, event in batch.records]
+        self.assertEqual(len(sequences), 4)
+        self.assertEqual(sequences, sorted(set(sequences)))
+
+    def test_ack_compacts(self):
+        spool = send_signifai.EventSpool(self.path, compact_bytes=1)
+        for _ in range(3):
+            spool.append("TEST_API_KEY", self.event)
+        first = spool.next_batch(1, timeout=0)
+        spool.ack(first)
+        header = send_signifai.SPOOL_HEADER.size
+        self.assertEqual(os.path.getsize(self.path),
+                         header + spool.pending())
+        rest = spool.next_batch(10, timeout=0)
+        self.assertEqual(len(rest.records), 2)
+        spool.ack(rest)
+        spool.close()
+        self.assertEqual(os.path.getsize(self.path), header)
+
+    def test_drained_spool_not_rewritten(self):
+        spool = send_signifai.EventSpool(self.path)
+        spool.append("TEST_API_KEY", self.event)
+        spool.ack(spool.next_batch(1, timeout=0))
+        spool.close()
+        self.assertEqual(spool.generation, 0)
+        self.assertEqual(spool.pending(), 0)
+
+    def test_appends_continue_while_compacting(self):
+        spool = send_signifai.EventSpool(self.path, compact_bytes=1)
+        for n in range(3):
+            spool.append("TEST_API_KEY", dict(self.event, application=str(n)))
+        first = spool.next_batch(1, timeout=0)
+        copy_bytes = send_signifai.copy_bytes
+        appended = []
+
+        def copy_and_append(source, dest, count):
+            if not appended:
+                # The tail is copied without the spool lock held
+                writer = threading.Thread(
+                    target=spool.append,
+                    args=("TEST_API_KEY", dict(self.event, application="3")))
+                writer.start()
+                writer.join(5)
+                appended.append(not writer.is_alive())
+            copy_bytes(source, dest, count)
+
+        with unittest_mock.patch.object(send_signifai, "copy_bytes",
+                                        side_effect=copy_and_append):
+            spool.ack(first)
+        spool.close()
+        self.assertEqual(appended, [True])
+
+        spool = send_signifai.EventSpool(self.path)
+        batch = spool.next_batch(10, timeout=0)
+        spool.close()
+        self.assertEqual(spool.generation, 1)
+        self.assertEqual([event.get("application")
+                          for _, event in batch.records], ["1", "2", "3"])
+
+    def test_high_water_persists(self):
+        spool = send_signifai.EventSpool(self.path)
+        spool.append("TEST_API_KEY", dict(self.event, application="1"))
+        for _ in range(2):
+            spool.append("TEST_API_KEY", dict(self.event, application="2"))
+        spool.next_batch(1, timeout=0)
+        rest = spool.next_batch(2, timeout=0)
+        # Another lane got trigger 2 out before trigger 1 was acked
+        spool.mark_delivered([event for _, event in rest.records])
+        spool.close()
+
+        spool = send_signifai.EventSpool(self.path)
+        batch = spool.next_batch(10, timeout=0)
+        self.assertEqual([spool.delivered(event)
+                          for _, event in batch.records],
+                         [False, True, True])
+        spool.ack(batch)
+        # Acknowledging past them forgets them again
+        self.assertEqual(spool.high_water, {})
+        spool.close()
+
+    def test_group_commit(self):
+        spool = send_signifai.EventSpool(self.path)
+        fsync = os.fsync
+        calls = []
+
+        def slow_fsync(fileno):
+            calls.append(fileno)
+            time.sleep(0.05)
+            fsync(fileno)
+
+        with unittest_mock.patch.object(send_signifai.os, "fsync",
+                                        side_effect=slow_fsync):
+            writers = [threading.Thread(target=spool.append,
+                                        args=("TEST_API_KEY", self.event))
+                       for _ in range(10)]
+            for writer in writers:
+                writer.start()
+            for writer in writers:
+                writer.join()
+        batch = spool.next_batch(20, timeout=0)
+        spool.close()
+        self.assertEqual(len(batch.records), 10)
+        self.assertLess(len(calls), 10)
+
+    def crash_compacting(self, target, name, crash_on=""):
+        spool = send_signifai.EventSpool(self.path, compact_bytes=1)
+        for n in range(3):
+            spool.append("TEST_API_KEY", dict(self.event, application=str(n)))
+        spool.ack(spool.next_batch(1, timeout=0))
+        second = spool.next_batch(1, timeout=0)
+        original = getattr(target, name)
+
+        def crash(path, *args):
+            if path.endswith(crash_on):
+                raise OSError("crashed")
+            return original(path, *args)
+
+        with unittest_mock.patch.object(target, name, side_effect=crash):
+            self.assertRaises(OSError, spool.ack, second)
+        # The process died here; nothing else gets written
+        spool.writer.close()
+        spool.reader.close()
+
+        spool = send_signifai.EventSpool(self.path)
+        batch = spool.next_batch(10, timeout=0)
+        spool.close()
+        return [event.get("application") for _, event in batch.records]
+
+    def test_crash_before_cursor_moves(self):
+        # The compacted file is thrown away and the old cursor still holds
+        self.assertEqual(self.crash_compacting(send_signifai,
+                                               "write_file_atomic"),
+                         ["1", "2"])
+        self.assertFalse(os.path.exists(self.path + ".compact"))
+
+    def test_crash_before_rename(self):
+        # The cursor already moved on, so the rename is finished on open
+        self.assertEqual(self.crash_compacting(send_signifai.os, "rename",
+                                               ".compact"), ["2"])
+        self.assertFalse(os.path.exists(self.path + ".compact"))
+
+
+class TestHostEnrichment(unittest.TestCase):
+    EXPORT = {
+        "zabbix_export": {
+            "version": "4.0",
+            "hosts": [{
+                "host": "testhost01",
+                "name": "testhost01.zabbix.net",
+                "groups": [{"name": "Linux servers"}],
+                "inventory": {"os": "CentOS 7"},
+                "tags": [{"tag": "env", "value": "prod"}]
+            }, {
+                "host": "testhost02",
+                "groups": [{"name": "Databases"}]
+            }]
+        }
+    }
+
+    def setUp(self):
+        logging.getLogger("enrichment").setLevel(100)
+        logging.getLogger("bugsnag_unattached_notify").setLevel(100)
+        self.tmpdir = tempfile.mkdtemp()
+        self.export_path = os.path.join(self.tmpdir, "hosts.json")
+        self.cache_path = os.path.join(self.tmpdir, "hosts.cache")
+        with open(self.export_path, "w") as export_file:
+            json.dump(self.EXPORT, export_file)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def event(self, host):
+        return send_signifai.prepare_REST_event(dict(
+            TestPrepareRESTEvent.BEST_CASE, **{"HOST.NAME": host}))
+
+    def test_file_source(self):
+        enricher = send_signifai.HostEnricher(
+            send_signifai.FileHostSource(self.export_path))
+        events = enricher.enrich_all([self.event("testhost01.zabbix.net"),
+                                      self.event("testhost02"),
+                                      self.event("unknown")])
+        self.assertEqual(events[0]["attributes"]["zabbix/host/tags/env"],
+                         "prod")
+        self.assertEqual(events[0]["attributes"]["zabbix/host/groups"],
+                         "Linux servers")
+        self.assertEqual(events[1]["attributes"]["zabbix/host/groups"],
+                         "Databases")
+        self.assertEqual(events[2], self.event("unknown"))
+
+    def test_malformed_export(self):
+        with open(self.export_path, "w") as export_file:
+            json.dump({"zabbix_export": {"hosts": [{
+                "host": "testhost02",
+                "groups": [{"uuid": "dc579cd7a1a34222933f24f52a68bcd8"}]
+            }]}}, export_file)
+        enricher = send_signifai.HostEnricher(
+            send_signifai.FileHostSource(self.export_path))
+        event = enricher.enrich(self.event("testhost02"))
+        self.assertEqual(event, self.event("testhost02"))
+
+    def test_cache_persists(self):
+        cache = send_signifai.HostMetadataCache(self.cache_path)
+        send_signifai.HostEnricher(
+            send_signifai.FileHostSource(self.export_path),
+            cache).enrich(self.event("testhost02"))
+
+        # A later invocation never needs to read the export
+        os.remove(self.export_path)
+        enricher = send_signifai.HostEnricher(
+            send_signifai.FileHostSource(self.export_path),
+            send_signifai.HostMetadataCache(self.cache_path))
+        event = enricher.enrich(self.event("testhost02"))
+        self.assertEqual(event["attributes"]["zabbix/host/groups"],
+                         "Databases")
+
+    def test_file_source_caches_whole_export(self):
+        source = send_signifai.FileHostSource(self.export_path)
+        send_signifai.HostEnricher(
+            source, send_signifai.HostMetadataCache(self.cache_path)).enrich(
+                self.event("testhost02"))
+
+        cache = send_signifai.HostMetadataCache(self.cache_path)
+        self.assertEqual(sorted(cache.entries),
+                         ["testhost01", "testhost01.zabbix.net",
+                          "testhost02"])
+        # The next script invocation finds the other host without
+        # parsing the export again
+        with unittest_mock.patch.object(send_signifai.FileHostSource,
+                                        "_load") as load:
+            event = send_signifai.HostEnricher(
+                send_signifai.FileHostSource(self.export_path),
+                cache).enrich(self.event("testhost01.zabbix.net"))
+        self.assertFalse(load.called)
+        self.assertEqual(event["attributes"]["zabbix/host/tags/env"], "prod")
+
+    def test_cache_ttl(self):
+        cache = send_signifai.HostMetadataCache(self.cache_path, ttl=60)
+        cache.put("testhost02", {"groups": ["Databases"]})
+        cache.save()
+        self.assertEqual(cache.get("testhost02"), {"groups": ["Databases"]})
+        later = time.time() + 61
+        with unittest_mock.patch.object(send_signifai.time, "time",
+                                        return_value=later):
+            self.assertIsNone(cache.get("testhost02"))
+            self.assertIsNone(send_signifai.HostMetadataCache(
+                self.cache_path).get("testhost02"))
+
+    def test_concurrent_saves(self):
+        errors = []
+
+        def save(num):
+            cache = send_signifai.HostMetadataCache(self.cache_path)
+            try:
+                for n in range(20):
+                    cache.put("host{num}".format(num=num), {"n": n})
+                    cache.save()
+            except Exception as exc:
+                errors.append(exc)
+
+        # Like separate script invocations saving the same cache file
+        with unittest_mock.patch.object(send_signifai.logging,
+                                        "getLogger") as get_logger:
+            threads = [threading.Thread(target=save, args=(num,))
+                       for num in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(errors, [])
+        self.assertFalse(get_logger.return_value.warning.called)
+        # Whichever save came last, the file is whole
+        self.assertTrue(send_signifai.HostMetadataCache(
+            self.cache_path).entries)
+        self.assertEqual(sorted(os.listdir(self.tmpdir)),
+                         ["hosts.cache", "hosts.json"])
+
+    def test_cache_lru(self):
+        cache = send_signifai.HostMetadataCache(max_entries=2)
+        cache.put("a", {})
+        cache.put("b", {})
+        cache.get("a")
+        cache.put("c", {})
+        self.assertEqual(cache.get("a"), {})
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("c"), {})
+
+
+class CollectorHandler(http_server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        self.server.clients.add(self.client_address)
+        body = self.rfile.read(int(self.headers.get("Content-Length")))
+        self.server.received.append(json.loads(body.decode("utf-8")))
+        response = json.dumps({"success": True,
+                               "failed_events": []}).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class SlowFlakyCollectorHandler(CollectorHandler):
+    """
+    Takes a random time to answer and fails some requests outright,
+    so concurrent deliveries finish out of order and get retried
+    """
+
+    def do_POST(self):
+        with self.server.lock:
+            self.server.active += 1
+            self.server.peak = max(self.server.peak, self.server.active)
+        try:
+            time.sleep(random.uniform(0, 0.02))
+            if random.random() < 0.2:
+                self.rfile.read(int(self.headers.get("Content-Length")))
+                self.send_response(500)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            with self.server.lock:
+                CollectorHandler.do_POST(self)
+        finally:
+            with self.server.lock:
+                self.server.active -= 1
+
+
+class KeyCheckingCollectorHandler(CollectorHandler):
+    """
+    Refuses requests made with the wrong API key, like the real
+    collector does
+    """
+
+    def do_POST(self):
+        if self.headers.get("Authorization") != "Bearer TEST_API_KEY":
+            self.rfile.read(int(self.headers.get("Content-Length")))
+            self.send_response(401)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        CollectorHandler.do_POST(self)
+
+
+class MalformedCollectorHandler(CollectorHandler):
+    """Accepts requests but answers with JSON that isn't a result"""
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length")))
+        self.send_response(200)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"[]")
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, http_server.HTTPServer):
+    daemon_threads = True
+
+
+class LocalCollector(object):
+    """
+    Plain HTTP stand-in for the SignifAI collector that records
+    every body it is sent
+    """
+
+    def __init__(self, handler=CollectorHandler,
+                 server_class=ThreadingHTTPServer):
+        self.server = server_class(("127.0.0.1", 0), handler)
+        self.server.received = []
+        self.server.clients = set()
+        self.server.lock = threading.Lock()
+        self.server.active = 0
+        self.server.peak = 0
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def post_kwargs(self):
+        return {
+            "signifai_host": "127.0.0.1",
+            "signifai_port": self.server.server_address[1],
+            "httpsconn": http_client.HTTPConnection
+        }
+
+    @property
+    def events(self):
+        return [event for body in self.server.received
+                for event in body["events"]]
+
+    def wait_for(self, count, timeout=5):
+        deadline = time.time() + timeout
+        while len(self.events) < count and time.time() < deadline:
+            time.sleep(0.01)
+        return self.events
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class TestIngestServer(unittest.TestCase):
+    MESSAGE = str.join("\n", [
+        "TRIGGER.DESCRIPTION: Something went wrong!",
+        "TRIGGER.ID: 1515",
+        "TRIGGER.NAME: boopHost",
+        "TRIGGER.NSEVERITY: 5",
+        "HOST.NAME: testhost01.zabbix.net",
+        "TRIGGER.STATUS: PROBLEM",
+        "TRIGGER.EXPRESSION: errors >= 1",
+        "_API_KEY: TEST_API_KEY"
+    ])
+
+    def setUp(self):
+        logging.getLogger("http_post").setLevel(100)
+        logging.getLogger("ingest").setLevel(100)
+        self.tmpdir = tempfile.mkdtemp()
+        self.spool_path = os.path.join(self.tmpdir, "spool")
+        self.collector = LocalCollector()
+        self.spool = send_signifai.EventSpool(self.spool_path)
+        self.dispatcher = send_signifai.SpoolDispatcher(
+            self.spool, retry_delay=0.05, **self.collector.post_kwargs)
+        self.server = send_signifai.IngestServer(("127.0.0.1", 0),
+                                                 self.spool, threads=4)
+        server_thread = threading.Thread(target=self.server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.dispatcher.stop()
+        self.spool.close()
+        self.collector.close()
+        shutil.rmtree(self.tmpdir)
+
+    def post(self, body, headers=None):
+        conn = http_client.HTTPConnection(*self.server.server_address)
+        conn.request("POST", "/", body=body, headers=headers or {})
+        res = conn.getresponse()
+        res.read()
+        conn.close()
+        return res.status
+
+    def test_accepts_zabbix_message(self):
+        self.assertEqual(self.post(self.MESSAGE), 202)
+        self.dispatcher.start()
+        events = self.collector.wait_for(1)
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0]["application"], "1515")
+        self.assertEqual(events[0]["attributes"]["state"], "alarm")
+
+    def test_accepts_json_message(self):
+        body = json.dumps({
+            "TRIGGER.DESCRIPTION": "Something went wrong!",
+            "TRIGGER.ID": 1515,
+            "TRIGGER.NAME": "boopHost",
+            "TRIGGER.NSEVERITY": 5,
+            "HOST.NAME": "testhost01.zabbix.net",
+            "TRIGGER.STATUS": "OK",
+            "TRIGGER.EXPRESSION": "errors >= 1"
+        })
+        status = self.post(body, {"Content-Type": "application/json",
+                                  "Authorization": "Bearer TEST_API_KEY"})
+        self.assertEqual(status, 202)
+        self.dispatcher.start()
+        events = self.collector.wait_for(1)
+        self.assertEqual(events[0]["value"], "critical")
+        self.assertEqual(events[0]["attributes"]["state"], "ok")
+
+    def test_rejects_invalid_message(self):
+        self.assertEqual(self.post("this template is not valid"), 400)
+        self.assertEqual(self.spool.pending(), 0)
+
+    def test_rejects_missing_api_key(self):
+        body = self.MESSAGE.replace("_API_KEY: TEST_API_KEY", "")
+        self.assertEqual(self.post(body.strip()), 401)
+
+    def test_spool_full(self):
+        self.spool.max_bytes = 10
+        self.assertEqual(self.post(self.MESSAGE), 503)
+
+    def test_batches_many_requests(self):
+        for _ in range(50):
+            self.assertEqual(self.post(self.MESSAGE), 202)
+        self.dispatcher.start()
+        self.assertEqual(len(self.collector.wait_for(50)), 50)
+        # They should have been sent in far fewer requests than events
+        self.assertLess(len(self.collector.server.received), 50)
+        deadline = time.time() + 5
+        while self.spool.pending() and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.spool.pending(), 0)
+
+    def test_spool_replays_after_restart(self):
+        for _ in range(3):
+            self.assertEqual(self.post(self.MESSAGE), 202)
+        self.spool.close()
+
+        self.spool = send_signifai.EventSpool(self.spool_path)
+        self.dispatcher = send_signifai.SpoolDispatcher(
+            self.spool, retry_delay=0.05, **self.collector.post_kwargs)
+        self.dispatcher.start()
+        self.assertEqual(len(self.collector.wait_for(3)), 3)
+
+    def test_refused_events_are_dead_lettered(self):
+        self.collector.close()
+        self.collector = LocalCollector(KeyCheckingCollectorHandler)
+        dead_letter = os.path.join(self.tmpdir, "dead")
+        self.dispatcher = send_signifai.SpoolDispatcher(
+            self.spool, retry_delay=0.05, dead_letter=dead_letter,
+            **self.collector.post_kwargs)
+        bad = self.MESSAGE.replace("TEST_API_KEY", "WRONG_API_KEY")
+        self.assertEqual(self.post(bad), 202)
+        self.assertEqual(self.post(self.MESSAGE), 202)
+        self.dispatcher.start()
+
+        self.assertEqual(len(self.collector.wait_for(1)), 1)
+        deadline = time.time() + 5
+        while self.spool.pending() and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.spool.pending(), 0)
+        with open(dead_letter) as dead_letter_file:
+            refused = [json.loads(line) for line in dead_letter_file]
+        self.assertEqual(len(refused), 1)
+        self.assertEqual(refused[0]["api_key"], "WRONG_API_KEY")
+        self.assertEqual(refused[0]["status"], 401)
+        self.assertEqual(refused[0]["event"]["application"], "1515")
+
+    def test_malformed_response_is_dead_lettered(self):
+        self.collector.close()
+        self.collector = LocalCollector(MalformedCollectorHandler)
+        dead_letter = os.path.join(self.tmpdir, "dead")
+        self.dispatcher = send_signifai.SpoolDispatcher(
+            self.spool, retry_delay=0.05, dead_letter=dead_letter,
+            **self.collector.post_kwargs)
+        self.assertEqual(self.post(self.MESSAGE), 202)
+        self.dispatcher.start()
+
+        deadline = time.time() + 5
+        while self.spool.pending() and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.spool.pending(), 0)
+        with open(dead_letter) as dead_letter_file:
+            refused = [json.loads(line) for line in dead_letter_file]
+        self.assertEqual(len(refused), 1)
+        self.assertEqual(refused[0]["status"], 200)
+
+    def test_worker_survives_unexpected_error(self):
+        dead_letter = os.path.join(self.tmpdir, "dead")
+        self.dispatcher = send_signifai.SpoolDispatcher(
+            self.spool, workers=1, batch_size=1, retry_delay=0.05,
+            dead_letter=dead_letter, **self.collector.post_kwargs)
+        deliver = self.dispatcher._deliver
+        calls = []
+
+        def flaky_deliver(client, records):
+            calls.append(records)
+            if len(calls) == 1:
+                raise KeyError("success")
+            return deliver(client, records)
+        self.dispatcher._deliver = flaky_deliver
+
+        self.assertEqual(self.post(self.MESSAGE), 202)
+        self.assertEqual(self.post(self.MESSAGE), 202)
+        self.dispatcher.start()
+        self.assertEqual(len(self.collector.wait_for(1)), 1)
+        deadline = time.time() + 5
+        while self.spool.pending() and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.spool.pending(), 0)
+        with open(dead_letter) as dead_letter_file:
+            dropped = [json.loads(line) for line in dead_letter_file]
+        self.assertEqual(len(dropped), 1)
+        self.assertIsNone(dropped[0]["status"])
+
+    def test_worker_reuses_connection(self):
+        self.dispatcher = send_signifai.SpoolDispatcher(
+            self.spool, workers=1, batch_size=1, retry_delay=0.05,
+            **self.collector.post_kwargs)
+        for _ in range(5):
+            self.assertEqual(self.post(self.MESSAGE), 202)
+        self.dispatcher.start()
+        self.assertEqual(len(self.collector.wait_for(5)), 5)
+        self.assertEqual(len(self.collector.server.received), 5)
+        self.assertEqual(len(self.collector.server.clients), 1)
+
+    def test_should_retry(self):
+        self.assertTrue(send_signifai.should_retry(False, None))
+        self.assertTrue(send_signifai.should_retry(False, 503))
+        self.assertTrue(send_signifai.should_retry(False, 429))
+        self.assertFalse(send_signifai.should_retry(False, 401))
+        self.assertFalse(send_signifai.should_retry(False, 200))
+        self.assertFalse(send_signifai.should_retry(None, 200))
+        self.assertFalse(send_signifai.should_retry(True, 200))
+
+
+class TestDeliveryOrdering(unittest.TestCase):
+    TRIGGERS = 8
+    EVENTS = 240
+
+    def setUp(self):
+        logging.getLogger("http_post").setLevel(100)
+        logging.getLogger("bugsnag_unattached_notify").setLevel(100)
+        self.tmpdir = tempfile.mkdtemp()
+        self.collector = LocalCollector(SlowFlakyCollectorHandler,
+                                        ThreadingHTTPServer)
+        self.spool = send_signifai.EventSpool(
+            os.path.join(self.tmpdir, "spool"))
+
+    def tearDown(self):
+        self.spool.close()
+        self.collector.close()
+        shutil.rmtree(self.tmpdir)
+
+    def fill(self):
+        for n in range(self.EVENTS):
+            trigger = n % self.TRIGGERS
+            self.spool.append("TEST_API_KEY", send_signifai.prepare_REST_event(
+                dict(TestPrepareRESTEvent.BEST_CASE, **{
+                    "TRIGGER.ID": str(trigger),
+                    "HOST.NAME": "host{num}".format(num=trigger % 3),
+                    "TRIGGER.STATUS": "OK" if n % 2 else "PROBLEM",
+                    "N": str(n)
+                })))
+
+    def dispatcher(self):
+        return send_signifai.SpoolDispatcher(
+            self.spool, workers=4, batch_size=5, retry_delay=0.01,
+            **self.collector.post_kwargs)
+
+    def assertInOrder(self, events):
+        by_key = {}
+        for event in events:
+            key = (event["application"], event["host"])
+            by_key.setdefault(key, []).append(event["attributes"])
+        self.assertEqual(len(by_key), self.TRIGGERS)
+        for attributes in by_key.values():
+            order = [int(a["zabbix/n"]) for a in attributes]
+            self.assertEqual(order, sorted(order))
+            sequences = [a[send_signifai.SEQUENCE_ATTR] for a in attributes]
+            self.assertEqual(sequences, sorted(set(sequences)))
+
+    def test_per_trigger_order(self):
+        self.fill()
+        dispatcher = self.dispatcher()
+        dispatcher.start()
+        try:
+            events = self.collector.wait_for(self.EVENTS, timeout=60)
+        finally:
+            dispatcher.stop()
+
+        self.assertEqual(len(events), self.EVENTS)
+        self.assertInOrder(events)
+        # ... while unrelated triggers were still sent side by side
+        self.assertGreater(self.collector.server.peak, 1)
+
+    def test_per_trigger_order_across_restart(self):
+        self.fill()
+        dispatcher = self.dispatcher()
+        dispatcher.start()
+        try:
+            self.collector.wait_for(self.EVENTS // 2, timeout=60)
+        finally:
+            dispatcher.stop()
+        self.spool.close()
+
+        self.spool = send_signifai.EventSpool(
+            os.path.join(self.tmpdir, "spool"))
+        dispatcher = self.dispatcher()
+        dispatcher.start()
+        try:
+            events = self.collector.wait_for(self.EVENTS, timeout=60)
+            deadline = time.time() + 5
+            while self.spool.pending() and time.time() < deadline:
+                time.sleep(0.01)
+        finally:
+            dispatcher.stop()
+
+        self.assertEqual(sorted(int(e["attributes"]["zabbix/n"])
+                                for e in events), list(range(self.EVENTS)))
+        self.assertInOrder(events)
+
+
+class ZabbixRPCHandler(http_server.BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length")))
+        request = json.loads(body.decode("utf-8"))
+        if self.server.drops:
+            # Like a frontend closing an idle kept-alive connection
+            self.server.drops -= 1
+            self.close_connection = True
+            return
+        self.server.calls.append(request)
+        params = request["params"]
+        error = "Not authorised."
+
+        if request["method"] == "user.login":
+            result = self.server.token
+        elif request.get("auth") != self.server.token:
+            result = None
+        elif request["method"] == "host.get":
+            if "selectGroups" in params and self.server.new_host_groups:
+                result = None
+                error = ('Invalid parameter "/": unexpected parameter '
+                         '"selectGroups".')
+            else:
+                names = params.get("filter", {}).get("name")
+                result = [h for h in self.server.hosts
+                          if names is None or h["name"] in names]
+        else:
+            events = sorted(self.server.events,
+                            key=lambda e: int(e["eventid"]),
+                            reverse=params["sortorder"] == "DESC")
+            if "eventid_from" in params:
+                events = [e for e in events
+                          if int(e["eventid"]) >= int(params["eventid_from"])]
+            result = events[:params["limit"]]
+
+        if result is None:
+            response = {"jsonrpc": "2.0", "id": request["id"],
+                        "error": {"code": -32602, "message": "Invalid params.",
+                                  "data": error}}
+        else:
+            response = {"jsonrpc": "2.0", "id": request["id"],
+                        "result": result}
+        data = json.dumps(response).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestZabbixPoller(unittest.TestCase):
+    def zabbix_event(self, eventid, value="1"):
+        return {
+            "eventid": str(eventid),
+            "source": "0",
+            "object": "0",
+            "objectid": "1515",
+            "clock": "1515925860",
+            "value": value,
+            "hosts": [{"hostid": "10084", "host": "testhost01",
+                       "name": "testhost01.zabbix.net"}],
+            "relatedObject": {
+                "triggerid": "1515",
+                "description": "boopHost",
+                "comments": "Something went wrong!",
+                "expression": "errors >= 1",
+                "priority": "5"
+            }
+        }
+
+    def setUp(self):
+        logging.getLogger("http_post").setLevel(100)
+        logging.getLogger("zabbix_poll").setLevel(100)
+        self.tmpdir = tempfile.mkdtemp()
+        self.cursor_path = os.path.join(self.tmpdir, "cursor")
+        self.collector = LocalCollector()
+        self.zabbix = http_server.HTTPServer(("127.0.0.1", 0),
+                                             ZabbixRPCHandler)
+        self.zabbix.calls = []
+        self.zabbix.token = "TEST_TOKEN"
+        self.zabbix.drops = 0
+        self.zabbix.events = [self.zabbix_event(i) for i in range(1, 6)]
+        self.zabbix.new_host_groups = False
+        self.zabbix.hosts = [{
+            "hostid": "10084",
+            "host": "testhost01",
+            "name": "testhost01.zabbix.net",
+            "groups": [{"groupid": "2", "name": "Linux servers"},
+                       {"groupid": "4", "name": "Databases"}],
+            "inventory": {"os": "CentOS 7", "location": "", "hostid": "10084"},
+            "tags": [{"tag": "Service Tier", "value": "gold"}]
+        }]
+        zabbix_thread = threading.Thread(target=self.zabbix.serve_forever)
+        zabbix_thread.daemon = True
+        zabbix_thread.start()
+        self.api = send_signifai.ZabbixAPI(
+            "http://127.0.0.1:{port}/zabbix".format(
+                port=self.zabbix.server_address[1]))
+        self.api.login("signifai", "password")
+
+    def tearDown(self):
+        self.api.close()
+        self.zabbix.shutdown()
+        self.zabbix.server_close()
+        self.collector.close()
+        shutil.rmtree(self.tmpdir)
+
+    def poller(self, **kwargs):
+        kwargs.update(self.collector.post_kwargs)
+        return send_signifai.ZabbixEventPoller(
+            self.api, send_signifai.EventCursor(self.cursor_path),
+            "TEST_API_KEY", **kwargs)
+
+    def test_event_matches_template_event(self):
+        msg = send_signifai.zabbix_event_to_msg(self.zabbix_event(7))
+        self.assertEqual(msg.pop("EVENT.ID"), "7")
+        self.assertEqual(send_signifai.prepare_REST_event(msg),
+                         send_signifai.prepare_REST_event(
+                             TestPrepareRESTEvent.BEST_CASE))
+
+    def test_non_ascii_event(self):
+        event = self.zabbix_event(7)
+        event["hosts"][0]["name"] = u"caf\u00e9.zabbix.net"
+        event["relatedObject"]["description"] = u"Caf\u00e9 \u2603 down"
+        j = send_signifai.prepare_REST_event(
+            send_signifai.zabbix_event_to_msg(event))
+        self.assertEqual(j["host"], u"caf\u00e9.zabbix.net")
+        self.assertEqual(j["attributes"]["zabbix/event/id"], "7")
+
+    def test_recovery_event(self):
+        j = send_signifai.prepare_REST_event(
+            send_signifai.zabbix_event_to_msg(self.zabbix_event(7, "0")))
+        self.assertEqual(j["attributes"]["state"], "ok")
+        self.assertEqual(j["attributes"]["zabbix/event/id"], "7")
+
+    def test_first_poll_starts_at_newest_event(self):
+        self.assertEqual(self.poller().poll_once(), 0)
+        self.assertEqual(self.collector.events, [])
+        self.assertEqual(send_signifai.EventCursor(self.cursor_path).eventid,
+                         5)
+
+    def test_backfill_pages(self):
+        sent = self.poller(page_size=2, backfill=True).poll_once()
+        self.assertEqual(sent, 5)
+        self.assertEqual(len(self.collector.server.received), 3)
+        self.assertEqual(
+            [e["attributes"]["zabbix/event/id"]
+             for e in self.collector.events],
+            ["1", "2", "3", "4", "5"])
+        self.assertEqual(send_signifai.EventCursor(self.cursor_path).eventid,
+                         5)
+
+    def test_resumes_from_cursor(self):
+        self.poller().poll_once()
+        self.zabbix.events.append(self.zabbix_event(6, "0"))
+        self.zabbix.events.append(self.zabbix_event(7))
+        self.assertEqual(self.poller().poll_once(), 2)
+        self.assertEqual(
+            [e["attributes"]["zabbix/event/id"]
+             for e in self.collector.events],
+            ["6", "7"])
+
+    def test_failed_delivery_keeps_cursor(self):
+        poller = self.poller(backfill=True)
+        poller.post = lambda *args, **kwargs: False
+        self.assertIsNone(poller.poll_once())
+        self.assertIsNone(send_signifai.EventCursor(self.cursor_path).eventid)
+
+    def host_calls(self):
+        return [c for c in self.zabbix.calls if c["method"] == "host.get"]
+
+    def test_enrichment_from_api(self):
+        enricher = send_signifai.HostEnricher(
+            send_signifai.ZabbixHostSource(self.api))
+        events = [send_signifai.prepare_REST_event(
+            send_signifai.zabbix_event_to_msg(self.zabbix_event(i)))
+            for i in range(10)]
+        enricher.enrich_all(events)
+        attributes = events[-1]["attributes"]
+        self.assertEqual(attributes["zabbix/host/groups"],
+                         "Databases, Linux servers")
+        self.assertEqual(attributes["zabbix/host/inventory/os"], "CentOS 7")
+        self.assertEqual(attributes["zabbix/host/tags/service_tier"], "gold")
+        self.assertEqual(attributes["zabbix/host/id"], "10084")
+        self.assertNotIn("zabbix/host/inventory/location", attributes)
+        self.assertEqual(len(self.host_calls()), 1)
+
+        # Steady state: no more API calls, not even for unknown hosts
+        unknown = dict(TestPrepareRESTEvent.BEST_CASE,
+                       **{"HOST.NAME": "unknown"})
+        enricher.enrich(send_signifai.prepare_REST_event(unknown))
+        enricher.enrich(send_signifai.prepare_REST_event(unknown))
+        enricher.enrich_all(events)
+        self.assertEqual(len(self.host_calls()), 2)
+
+    def test_lookup_leaves_api_calls_to_background(self):
+        enricher = send_signifai.HostEnricher(
+            send_signifai.ZabbixHostSource(self.api))
+        enricher.start(interval=3600)
+        try:
+            event = enricher.lookup(send_signifai.prepare_REST_event(
+                send_signifai.zabbix_event_to_msg(self.zabbix_event(1))))
+            self.assertNotIn("zabbix/host/groups", event["attributes"])
+            deadline = time.time() + 5
+            while enricher.cache.get("testhost01.zabbix.net") is None and \
+                    time.time() < deadline:
+                time.sleep(0.01)
+            event = enricher.lookup(send_signifai.prepare_REST_event(
+                send_signifai.zabbix_event_to_msg(self.zabbix_event(2))))
+        finally:
+            enricher.stop()
+        self.assertEqual(event["attributes"]["zabbix/host/groups"],
+                         "Databases, Linux servers")
+        self.assertEqual(len(self.host_calls()), 1)
+
+    def test_refresh_before_expiry(self):
+        enricher = send_signifai.HostEnricher(
+            send_signifai.ZabbixHostSource(self.api),
+            send_signifai.HostMetadataCache(ttl=60))
+        enricher.prefetch(["testhost01.zabbix.net", "unknown"])
+        enricher.refresh(30)
+        self.assertEqual(len(self.host_calls()), 1)
+        enricher.refresh(120)
+        self.assertEqual(len(self.host_calls()), 2)
+        self.assertEqual(sorted(self.host_calls()[-1]["params"]["filter"]
+                                ["name"]),
+                         ["testhost01.zabbix.net", "unknown"])
+
+    def test_api_reconnects_after_dropped_connection(self):
+        self.zabbix.drops = 1
+        result = []
+        thread = threading.Thread(
+            target=lambda: result.append(self.api.call("host.get", {})))
+        thread.daemon = True
+        thread.start()
+        thread.join(5)
+        if thread.is_alive():
+            # Leave the deadlocked client behind so tearDown can finish
+            self.api = send_signifai.ZabbixAPI("http://127.0.0.1:1")
+            self.fail("call() hung")
+        self.assertEqual(len(result[0]), 1)
+
+    def test_api_shared_between_threads(self):
+        errors = []
+
+        def call():
+            try:
+                for _ in range(5):
+                    self.api.call("host.get", {})
+            except Exception as exc:
+                errors.append(exc)
+
+        threads = [threading.Thread(target=call) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(self.host_calls()), 40)
+
+    def test_enrichment_host_groups_renamed(self):
+        self.zabbix.new_host_groups = True
+        self.zabbix.hosts[0]["hostgroups"] = self.zabbix.hosts[0].pop(
+            "groups")
+        source = send_signifai.ZabbixHostSource(self.api)
+        metadata = source.fetch(["testhost01.zabbix.net"])
+        self.assertEqual(metadata["testhost01.zabbix.net"]["groups"],
+                         ["Databases", "Linux servers"])
+
+    def test_enrichment_keeps_groups_param_on_other_errors(self):
+        self.api.close()
+        self.api = send_signifai.ZabbixAPI(
+            "http://127.0.0.1:{port}/zabbix".format(
+                port=self.zabbix.server_address[1]), token="EXPIRED")
+        source = send_signifai.ZabbixHostSource(self.api)
+        with self.assertRaises(send_signifai.ZabbixAPIError):
+            source.fetch(["testhost01.zabbix.net"])
+        self.assertEqual(len(self.host_calls()), 1)
+        self.assertEqual(source.groups_param, "selectGroups")
+
+    def test_poller_enriches_page(self):
+        enricher = send_signifai.HostEnricher(
+            send_signifai.ZabbixHostSource(self.api))
+        self.poller(backfill=True, enricher=enricher).poll_once()
+        self.assertEqual(len(self.collector.events), 5)
+        for event in self.collector.events:
+            self.assertEqual(event["attributes"]["zabbix/host/groups"],
+                             "Databases, Linux servers")
+        self.assertEqual(len(self.host_calls()), 1)
+
+    def test_poll_main_logs_in_again(self):
+        sleeps = []
+
+        def sleep(seconds):
+            sleeps.append(seconds)
+            if len(sleeps) == 1:
+                # The session expires between two polls
+                self.zabbix.token = "NEW_TOKEN"
+            elif len(sleeps) == 3:
+                raise KeyboardInterrupt
+
+        argv = ["--api-url", "http://127.0.0.1:{port}/zabbix".format(
+                    port=self.zabbix.server_address[1]),
+                "--user", "signifai", "--password", "password",
+                "--api-key", "TEST_API_KEY", "--cursor", self.cursor_path,
+                "--interval", "30"]
+        with unittest_mock.patch.object(send_signifai, "configure_daemon"), \
+                unittest_mock.patch.object(send_signifai.time, "sleep",
+                                           side_effect=sleep), \
+                unittest_mock.patch.object(send_signifai, "bugsnag_notify"):
+            with self.assertRaises(KeyboardInterrupt):
+                send_signifai.poll_main(argv)
+        logins = [c for c in self.zabbix.calls if c["method"] == "user.login"]
+        # setUp's, the first poll's and the one after the session expired
+        self.assertEqual(len(logins), 3)
+        self.assertEqual(self.zabbix.calls[-1]["auth"], "NEW_TOKEN")
+
+    def test_api_logs_in_again(self):
+        self.zabbix.token = "NEW_TOKEN"
+        self.assertEqual(len(self.api.call("host.get", {})), 1)
+        logins = [c for c in self.zabbix.calls if c["method"] == "user.login"]
+        self.assertEqual(len(logins), 2)
+        self.assertEqual(self.api.token, "NEW_TOKEN")
+
+    def test_ingest_main_survives_failed_login(self):
+        logging.getLogger("enrichment").setLevel(100)
+        argv = ["--listen", "127.0.0.1:0",
+                "--spool", os.path.join(self.tmpdir, "spool"),
+                "--zabbix-url", "http://127.0.0.1:1/zabbix",
+                "--zabbix-user", "signifai", "--zabbix-password", "password"]
+        with unittest_mock.patch.object(send_signifai, "configure_daemon"), \
+                unittest_mock.patch.object(send_signifai, "bugsnag_notify"), \
+                unittest_mock.patch.object(send_signifai.IngestServer,
+                                           "serve_forever",
+                                           side_effect=KeyboardInterrupt):
+            self.assertEqual(send_signifai.ingest_main(argv), 0)
+
+    def test_api_error(self):
+        self.api.close()
+        self.api = send_signifai.ZabbixAPI(
+            "http://127.0.0.1:{port}/zabbix".format(
+                port=self.zabbix.server_address[1]), token="WRONG")
+        with self.assertRaises(send_signifai.ZabbixAPIError):
+            self.poller().poll_once()
+
+
 if __name__ == "__main__":
     unittest.main()